@@ -8,7 +8,7 @@ import datetime
 import time
 
 
-from zfel import sase1d
+from zfel import sase1d_input_part
 
 Nruns=1                             # Number of runs
 npart   = 512                       # n-macro-particles per bucket 
@@ -20,20 +20,23 @@ emitN   = 1.2e-6                    # normalized transverse emittance [m-rad]
 currentMax = 3900                   # peak current [Ampere]
 beta = 26                           # mean beta [meter]
 unduPeriod = 0.03                   # undulator period [meter]
-unduK = 3.5                         # undulator parameter, K [ ]
+unduK = np.ones(z_steps)*3.5        # undulator parameter, K [ ]
 unduL = 70#30                          # length of undulator [meter]
 radWavelength = 1.5e-9              # seed wavelength? [meter], used only in single-freuqency runs
 dEdz = 0                            # rate of relative energy gain or taper [keV/m], optimal~130
-iopt = 5                            # 5=SASE, 4=seeded
+iopt = 'sase'                       # 'sase' or 'seeded'
 P0 = 10000*0.0                       # small seed input power [W]
 constseed = 1                       # whether we want to use constant random seed for reproducibility, 1 Yes, 0 No
+particle_position = None            # particle information with positions in meter and eta, None for random loading
+hist_rule = 'square-root'           # rule for the number of intervals of the eta histogram in a bucket
 
 '''
 Put input parameters into a inp_struct dict, for 1D FEL run
 '''
 inp_struct={'Nruns':Nruns,'npart':npart,'s_steps':s_steps,'z_steps':z_steps,'energy':energy,'eSpread':eSpread,\
             'emitN':emitN,'currentMax':currentMax,'beta':beta,'unduPeriod':unduPeriod,'unduK':unduK,'unduL':\
-            unduL,'radWavelength':radWavelength,'dEdz':dEdz,'iopt':iopt,'P0':P0,'constseed':constseed}
+            unduL,'radWavelength':radWavelength,'dEdz':dEdz,'iopt':iopt,'P0':P0,'constseed':constseed,\
+            'particle_position':particle_position,'hist_rule':hist_rule}
 
 #%load_ext autoreload
 #%autoreload
@@ -42,7 +45,31 @@ Use sase function in sase1d.py to run 1D FEL
 '''
 z,power_z,s,power_s,rho,detune,field,\
 field_s,gainLength,resWavelength,\
-thet_out,gam_out,bunching,history=sase1d.sase(inp_struct)
+thet_out,gam_out,bunching,spectrum,freq,Ns,history=sase1d_input_part.sase(inp_struct)
 result_A=np.round(z,2)
 result_B=np.round(power_z,2)
-np.savetxt('test/z_and_power_z.now',np.column_stack((result_A,result_B)),delimiter=",", header="z,power_z")
\ No newline at end of file
+np.savetxt('test/z_and_power_z.now',np.column_stack((result_A,result_B)),delimiter=",", header="z,power_z")
+'''
+Single precision variant: same run with dtype='float32', the answer has to stay
+within the tolerance of the double precision one
+'''
+rtol_power = 0.05                   # relative tolerance on the power along the undulator
+inp_struct_32=dict(inp_struct,dtype='float32')
+z_32,power_z_32,*_=sase1d_input_part.sase(inp_struct_32)
+dev=np.abs(power_z_32-power_z)/np.max(power_z)
+print('float32 max relative deviation of power_z:',np.max(dev))
+print('float32 relative deviation of the final power:',np.abs(power_z_32[-1]/power_z[-1]-1))
+np.savetxt('test/z_and_power_z_float32.now',np.column_stack((np.round(z_32,2),np.round(power_z_32,2))),delimiter=",", header="z,power_z")
+assert np.max(dev)<rtol_power, 'float32 run deviates from float64 by more than rtol_power'
+'''
+Engine agreement with a seed: the 'zmajor' engine advances the same leap-frog as the
+'slice' engine, so with P0>0 (the seed reaching every slice at the entrance) both have
+to give the same power along the undulator to round-off
+'''
+rtol_engine = 1e-10                 # relative tolerance between the engines
+inp_struct_seed=dict(inp_struct,P0=1e6)
+power_z_slice=sase1d_input_part.sase(dict(inp_struct_seed,engine='slice'))[1]
+power_z_zmajor=sase1d_input_part.sase(dict(inp_struct_seed,engine='zmajor'))[1]
+dev_engine=np.max(np.abs(power_z_zmajor-power_z_slice))/np.max(power_z_slice)
+print('zmajor against slice engine with a seed, max relative deviation of power_z:',dev_engine)
+assert dev_engine<rtol_engine, "engine='zmajor' deviates from engine='slice' with a seed"
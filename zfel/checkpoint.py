@@ -0,0 +1,93 @@
+import os
+import pickle
+import uuid
+import numpy as np
+
+
+def save_inputs(directory,inp_struct,bucket_data):
+    '''
+    keep what a restart needs besides the checkpoints: the run inputs, the loaded buckets
+    and the state of the global random generator after loading them
+    particle_position is not kept, the buckets loaded from it are; the checkpoint of an earlier
+    run in the same directory is removed, and the new run gets an id its checkpoints must carry
+    outputs:
+    run_id              # id of the run, to pass to write_checkpoint
+    '''
+    os.makedirs(directory,exist_ok=True)
+    path=os.path.join(directory,'checkpoint.npz')
+    if os.path.exists(path):
+        os.remove(path)
+    run_id=uuid.uuid4().hex                                                 # not from np.random, the runs stay reproducible
+    atomic_write(os.path.join(directory,'inputs.pkl'),\
+                 lambda f: pickle.dump(dict(inp_struct,particle_position=None),f))
+    atomic_write(os.path.join(directory,'buckets.npz'),lambda f: np.savez(f,**bucket_data,**rng_arrays(),run_id=run_id))
+    return run_id
+
+
+def write_checkpoint(directory,step,run_id,state):
+    '''
+    write the state of a run at z boundary step (the steps before it are done), replacing
+    the previous checkpoint only once the new one is complete on disk
+    inputs:
+    directory           # checkpoint directory
+    step                # number of z steps done
+    run_id              # id of the run, as returned by save_inputs
+    state               # dict of arrays with the running state: particles, current field and bunching columns,
+                        # phase space records and the taper, stop and energy balance state; the field grid
+                        # itself stays in the run's output sink
+    the state of the global random generator is saved with it
+    '''
+    atomic_write(os.path.join(directory,'checkpoint.npz'),lambda f: np.savez(f,step=step,run_id=run_id,**rng_arrays(),**state))
+
+
+def read_checkpoint(directory):
+    '''
+    read back a checkpoint directory
+    outputs:
+    inp_struct          # inputs of the run
+    bucket_data         # the loaded buckets, with the 'run_id' of the run
+    rng_state           # state of the global random generator at the checkpoint (for np.random.set_state)
+    resume              # state of the latest checkpoint with its step, None if no checkpoint was written yet
+    a checkpoint left over from another run in the same directory raises ValueError
+    '''
+    with open(os.path.join(directory,'inputs.pkl'),'rb') as f:
+        inp_struct=pickle.load(f)
+    with np.load(os.path.join(directory,'buckets.npz')) as data:
+        bucket_data={name:data[name] for name in data.files}
+    rng_state=pop_rng(bucket_data)
+    bucket_data['s_steps']=int(bucket_data['s_steps'])
+    bucket_data['run_id']=str(bucket_data['run_id'])
+    path=os.path.join(directory,'checkpoint.npz')
+    if not os.path.exists(path):
+        return inp_struct,bucket_data,rng_state,None
+    with np.load(path) as data:
+        resume={name:data[name] for name in data.files}
+    if str(resume.pop('run_id'))!=bucket_data['run_id']:
+        raise ValueError('the checkpoint in '+directory+' belongs to another run than its inputs')
+    rng_state=pop_rng(resume)
+    resume['step']=int(resume['step'])
+    return inp_struct,bucket_data,rng_state,resume
+
+
+def rng_arrays():
+    '''
+    state of the global random generator as arrays for np.savez
+    '''
+    rng=np.random.get_state()
+    return {'rng_keys':rng[1],'rng_pos':rng[2],'rng_has_gauss':rng[3],'rng_gauss':rng[4]}
+
+
+def pop_rng(data):
+    return ('MT19937',data.pop('rng_keys'),int(data.pop('rng_pos')),int(data.pop('rng_has_gauss')),float(data.pop('rng_gauss')))
+
+
+def atomic_write(path,write):
+    '''
+    write(f) into a temporary file next to path, then move it over path
+    '''
+    tmp=path+'.tmp'
+    with open(tmp,'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp,path)
@@ -0,0 +1,122 @@
+import os
+import multiprocessing
+import numpy as np
+from zfel import sase1d_input_part
+from zfel import general_load_bucket
+from zfel.wavefront import shared_array, attach_array
+
+
+def run_ensemble(inp_struct,nruns,seed=None,nworkers=None):
+    '''
+    SASE ensemble over a local process pool
+    every run gets its own random stream spawned from one master SeedSequence, so
+    the ensemble is reproducible and does not depend on how many workers are used;
+    results are written by the workers straight into shared memory
+    inputs:
+    inp_struct          # input dict of sase(), Nruns, constseed, output_file and checkpoint_dir are ignored;
+                        # engine='wavefront' runs as 'zmajor', the pool workers cannot start worker processes;
+                        # the early stop options are not supported, the runs share buffers of the full z size
+    nruns               # number of independent runs
+    seed                # entropy of the master SeedSequence, None for fresh entropy
+    nworkers            # number of worker processes, default all cores
+    outputs:
+    power_z             # power profile along undulator, shape (nruns, z_steps)
+    power_s             # power profile along beam, shape (nruns, z_steps, s_steps)
+    field               # final output field along beam, shape (nruns, s_steps+1)
+    spectrum            # spectrum power, shape (nruns,)+spectrum shape of one run
+    bunching            # bunching factor, shape (nruns, s_steps, z_steps)
+    seed                # entropy of the master SeedSequence, to rerun the ensemble
+    '''
+    sase1d_input_part.check_inputs(inp_struct)
+    for key in ['stop_after','stop_drop']:
+        if inp_struct.get(key) is not None:
+            raise ValueError('ensemble runs do not support '+key)
+    master=np.random.SeedSequence(seed)
+    streams=master.spawn(nruns)
+    if nworkers is None:
+        nworkers=os.cpu_count()
+    nworkers=max(1,min(int(nworkers),nruns))
+
+    run_struct=dict(inp_struct,Nruns=1,constseed=0,output_file=None,checkpoint_dir=None)
+    if run_struct.get('engine')=='wavefront':
+        run_struct['engine']='zmajor'                                       # the runs are already spread over processes
+    handles={}
+    arrays={}
+    try:
+        for name,(shp,dtype) in ensemble_layout(run_struct).items():
+            handles[name],arrays[name]=shared_array((nruns,)+shp,dtype)
+        layout={name:(handles[name].name,arr.shape,arr.dtype.str) for name,arr in arrays.items()}
+        if nworkers==1:
+            init_worker(run_struct,layout)
+            for run,stream in enumerate(streams):
+                ensemble_task(run,stream)
+            release_worker()
+        else:
+            ctx=multiprocessing.get_context()
+            with ctx.Pool(nworkers,initializer=init_worker,initargs=(run_struct,layout)) as pool:
+                pool.starmap(ensemble_task,enumerate(streams),chunksize=1)
+        results={name:arr.copy() for name,arr in arrays.items()}
+    finally:
+        arrays.clear()
+        for shm in handles.values():
+            shm.close()
+            shm.unlink()
+    results['seed']=master.entropy
+    return results
+
+
+def ensemble_layout(inp_struct):
+    '''
+    shape and dtype of one run's entry for every ensemble output
+    '''
+    params=sase1d_input_part.params_calc(**inp_struct)
+    if inp_struct['iopt']=='seeded':
+        s_steps=1                                                           # steady state, one bucket
+    else:
+        s_steps=int(general_load_bucket.slice_steps(inp_struct['particle_position'],params['coopLength'],\
+                                                    params['dels'],inp_struct['s_steps']))
+    z_steps=inp_struct['z_steps']
+    stations=sase1d_input_part.spectrum_stations(inp_struct.get('spectrum_z'),z_steps).shape[0]
+    nfft=inp_struct.get('spectrum_nfft') or s_steps
+    return {'power_z':((z_steps,),np.float64),
+            'power_s':((z_steps,s_steps),np.float64),
+            'field':((s_steps+1,),np.complex128),
+            'spectrum':((stations,nfft),np.float64),
+            'bunching':((s_steps,z_steps),np.complex128)}
+
+
+worker_state={}
+
+def init_worker(inp_struct,layout):
+    '''
+    pool initializer: keep the inputs and attach to the shared result buffers once per worker
+    '''
+    worker_state['inp_struct']=inp_struct
+    worker_state['handles']={}
+    worker_state['arrays']={}
+    for name,spec in layout.items():
+        worker_state['handles'][name],worker_state['arrays'][name]=attach_array(*spec)
+
+
+def release_worker():
+    worker_state['arrays'].clear()
+    for shm in worker_state['handles'].values():
+        shm.close()
+    worker_state.clear()
+
+
+def ensemble_task(run,stream):
+    '''
+    one ensemble run: seed the random generator from the run's own stream, run sase()
+    and write the outputs into row run of the shared buffers
+    '''
+    np.random.seed(stream.generate_state(8))
+    out=sase1d_input_part.sase(worker_state['inp_struct'])
+    history=out[-1]
+    arrays=worker_state['arrays']
+    arrays['power_z'][run]=history['power_z']
+    arrays['power_s'][run]=history['power_s']
+    arrays['field'][run]=history['field']
+    arrays['spectrum'][run]=history['spectrum']
+    arrays['bunching'][run]=out[12]
+    return run
@@ -0,0 +1,106 @@
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def FEL_process_numba(thet_init,eta_init,shape,E02,npart,z_steps,ku,delt,dels,deta,kappa,Kai,record_z,record_slices,wrap=False):
+    '''
+    compiled leap-frog, same inputs and outputs as FEL_process_zmajor
+    inputs:
+    thet_init           # all buckets macro particles position, shape (s_steps, npart)
+    eta_init            # all buckets macro particles relative energy, shape (s_steps, npart)
+    shape               # relative current of each slice
+    kappa               # kappa_1*density along the undulator
+    record_z            # z stations (0..z_steps) where the phase space is recorded
+    record_slices       # slices whose phase space is recorded
+    wrap                # wrap theta modulo 2 pi after every step
+    outputs:
+    Er, Ei              # field grid, shape (s_steps+1, z_steps+1)
+    bunching            # bunching factor, shape (s_steps, z_steps)
+    thet_record         # recorded phases, shape (len(record_slices), len(record_z), npart)
+    eta_record          # recorded relative energies, same shape as thet_record
+    etaavg              # average energy of the last slice after every step, shape (z_steps,)
+    the arrays keep the dtype of thet_init, the sums run in double precision
+    '''
+    s_steps=thet_init.shape[0]
+    dtype=thet_init.dtype
+    Er=np.zeros((s_steps+1,z_steps+1),dtype=dtype)
+    Ei=np.zeros((s_steps+1,z_steps+1),dtype=dtype)
+    bunching=np.zeros((s_steps,z_steps),dtype=np.result_type(dtype,np.complex64))
+    thet_record=np.zeros((record_slices.shape[0],record_z.shape[0],npart),dtype=dtype)
+    eta_record=np.zeros((record_slices.shape[0],record_z.shape[0],npart),dtype=dtype)
+    etaavg=np.zeros(z_steps,dtype=dtype)
+    z_slot=-np.ones(z_steps+1,dtype=np.int64)
+    z_slot[record_z]=np.arange(record_z.shape[0])
+    slice_slot=-np.ones(s_steps,dtype=np.int64)
+    slice_slot[record_slices]=np.arange(record_slices.shape[0])
+    Er[:s_steps,0] = np.sqrt(E02)                                           # input seed signal
+    leapfrog_kernel(np.ascontiguousarray(thet_init),np.ascontiguousarray(eta_init),\
+                    np.asarray(shape,dtype=np.float64),Er,Ei,bunching,\
+                    z_slot,slice_slot,thet_record,eta_record,etaavg,\
+                    float(ku),float(delt),float(dels),np.asarray(deta,dtype=np.float64),\
+                    np.asarray(kappa,dtype=np.float64),np.asarray(Kai,dtype=np.float64),bool(wrap))
+    return Er,Ei,bunching,thet_record,eta_record,etaavg
+
+
+def leapfrog_kernel(thet_init,eta_init,shape,Er,Ei,bunching,z_slot,slice_slot,thet_record,eta_record,etaavg,\
+                    ku,delt,dels,deta,kappa,Kai,wrap):
+    '''
+    fused leap-frog over all slices and z steps, writes into Er, Ei, bunching, the records and etaavg
+    every particle is visited twice per step: once for the theta sums (which also
+    give the bunching) and once for the theta/eta update with the sums of the new theta
+    '''
+    s_steps,npart=thet_init.shape
+    z_steps=bunching.shape[1]
+    thethalf=np.empty(npart,dtype=thet_init.dtype)
+    eta=np.empty(npart,dtype=eta_init.dtype)
+    last=s_steps-1
+    for k in range(s_steps):
+        r=slice_slot[k]
+        for i in range(npart):
+            eta[i]=eta_init[k,i]
+            thethalf[i]=thet_init[k,i]-2*ku*eta[i]*delt/2                  # half back
+        if r>=0 and z_slot[0]>=0:
+            for i in range(npart):
+                eta_record[r,z_slot[0],i]=eta[i]
+                thet_record[r,z_slot[0],i]=thet_init[k,i]
+        for j in range(z_steps):
+            q=z_slot[j+1] if r>=0 else -1
+            sumsin=0.0
+            sumcos=0.0
+            for i in range(npart):
+                thet=thethalf[i]+2*ku*(eta[i]+deta[j])*delt/2
+                sumsin+=np.sin(thet)
+                sumcos+=np.cos(thet)
+                if q>=0:
+                    thet_record[r,q,i]=thet
+            Erhalf=Er[k,j]+kappa[j]*shape[k]*sumcos/npart*dels/2
+            Eihalf=Ei[k,j]-kappa[j]*shape[k]*sumsin/npart*dels/2
+            bunching[k,j]=sumcos/npart-1j*(sumsin/npart)
+            sumsin=0.0
+            sumcos=0.0
+            sumeta=0.0
+            for i in range(npart):
+                th=thethalf[i]+2*ku*(eta[i]+deta[j])*delt
+                if wrap:
+                    th=th%(2*np.pi)
+                sinth=np.sin(th)
+                costh=np.cos(th)
+                thethalf[i]=th
+                eta[i]=eta[i]-2*Kai[j]*Erhalf*costh*delt+2*Kai[j]*Eihalf*sinth*delt
+                sumsin+=sinth
+                sumcos+=costh
+                sumeta+=eta[i]
+                if q>=0:
+                    eta_record[r,q,i]=eta[i]
+            if k==last:
+                etaavg[j]=sumeta/npart
+            Er[k+1,j+1]=Er[k,j]+kappa[j]*shape[k]*sumcos/npart*dels           # apply slippage condition
+            Ei[k+1,j+1]=Ei[k,j]-kappa[j]*shape[k]*sumsin/npart*dels
+
+
+if numba is not None:
+    leapfrog_kernel=numba.njit(cache=True)(leapfrog_kernel)
@@ -1,7 +1,12 @@
+import hashlib
+from collections import OrderedDict
 import numpy as np
 import matplotlib.pyplot as plt
 
-def general_load_bucket(npart,Ns,coopLength,particle_position,s_steps,dels,hist_rule,gbar=None,delg=None,iopt=None,):
+# loaded buckets kept by general_load_bucket(cache=True), least recently used first
+bucket_cache={'entries':OrderedDict(),'nbytes':0,'max_bytes':2**28}
+
+def general_load_bucket(npart,Ns,coopLength,particle_position,s_steps,dels,hist_rule,gbar=None,delg=None,iopt=None,rng_compat=True,loading='beamlet',cache=False):
     '''
     random initialization of the beam load_bucket
     inputs:
@@ -11,53 +16,173 @@ def general_load_bucket(npart,Ns,coopLength,particle_position,s_steps,dels,hist_
     iopt                # 'sase' or 'seeded'
     Ns                  # N electrons per s-slice at maximum current
     coopLength          # cooperation length
-    particle_position   # particle information with positions in meter and eta
+    particle_position   # particle information with positions in meter and eta, or the slice histograms
+                        # streamed from a file by particle_stream.stream_particles
     s_steps             # n-sample points along bunch length
     dels                # integration step in s0
     hist_rule           # different rules to select number of intervals to generate the histogram of eta value in a bucket
+    rng_compat          # with particle_position, True draws the random numbers slice by slice in the historical
+                        # order (reproduces earlier runs), False draws every slice's numbers in one call each
+    loading             # 'beamlet' (default) for the beamlet loading, 'hammersley' for a quiet start on a
+                        # Hammersley set with shot noise added as one random bunching per slice
+
+    cache               # True to reuse buckets loaded before with the same inputs and random generator state
+                        # (see set_bucket_cache); the arrays returned are then read-only and the random
+                        # generator is left in the state the loading would have left it in
 
     outputs:
     thet_init           # all buckets macro particles position
     eta_init            # all buckets macro particles relative energy
     N_real              # real number of particles along the beam
     '''
-    if particle_position is None:
-        thet_init=np.zeros((s_steps,npart))
-        eta_init=np.zeros((s_steps,npart))
-        for j in range(s_steps):
-            [thet0,eta0] = load_bucket(npart,gbar,delg,iopt,Ns)     # load each bucket
-            thet_init[j,:]=thet0
-            eta_init[j,:]=eta0
+    if loading not in ('beamlet','hammersley'):
+        raise ValueError('unknown loading '+str(loading))
+    if cache:
+        key=bucket_key(npart,Ns,coopLength,particle_position,s_steps,dels,hist_rule,gbar,delg,iopt,rng_compat,loading,\
+                       np.random.get_state())
+        entries=bucket_cache['entries']
+        if key not in entries:
+            data=general_load_bucket(npart,Ns,coopLength,particle_position,s_steps,dels,hist_rule,gbar,delg,iopt,\
+                                     rng_compat,loading)
+            cache_store(key,data,np.random.get_state())
+        if key not in entries:                                          # too large to be kept
+            return data
+        entries.move_to_end(key)
+        data,state=entries[key]
+        np.random.set_state(state)
+        return {name:value.view() if isinstance(value,np.ndarray) else value for name,value in data.items()}
+
+    if particle_position is None and loading=='hammersley':
+        thet_init,eta_init = load_quiet(npart,gbar,delg,iopt,np.full(s_steps,Ns))
+        N_real=np.ones(s_steps)
+    elif particle_position is None:
+        thet_init,eta_init = load_bucket(npart,gbar,delg,iopt,Ns,nbucket=s_steps)     # load all buckets
         N_real=np.ones(s_steps)
     else:
-        #load particle information and classify them to different intervals
-        s_all=particle_position[:,0]
-        eta_all=particle_position[:,1]
-        s_steps=int(np.max(s_all)/(dels*coopLength))+1 if np.max(s_all)%(dels*coopLength)!=0 else np.max(s_all)/(dels*coopLength)
-        N_input=np.zeros(s_steps)
-        eta_step=[[] for x in range(s_steps)]
-        for k in range(s_all.shape[0]):
-            location=int(s_all[k]/(dels*coopLength))
-            N_input[location]+=1
-            eta_step[location].append(eta_all[k])
+        s_steps=slice_steps(particle_position,coopLength,dels,s_steps)
+        if isinstance(particle_position,dict):
+            #histograms streamed by particle_stream.stream_particles
+            if not np.isclose(particle_position['slice_length'],dels*coopLength):
+                raise ValueError('particles were streamed with slice length '+str(particle_position['slice_length'])\
+                                 +' m, the run uses '+str(dels*coopLength)+' m')
+            N_input=particle_position['N_input']
+        else:
+            #load particle information and classify them to different intervals
+            s_all=particle_position[:,0]
+            eta_all=particle_position[:,1]
+            location=np.floor_divide(s_all,dels*coopLength).astype(np.intp)
+            N_input=np.bincount(location,minlength=s_steps)
+            order=np.argsort(location,kind='stable')                   # particles of a slice become contiguous
+            eta_sorted=eta_all[order]
+            segment=np.concatenate(([0],np.cumsum(N_input)))            # slice k is eta_sorted[segment[k]:segment[k+1]]
         N_real=N_input/np.max(N_input)*Ns
         #generate theta and eta
         thet_init=np.zeros((s_steps,npart))
         eta_init=np.zeros((s_steps,npart))
-        for k in range(s_steps):
-            if N_real[k]==0:
-                thet_init[k,:]=np.random.rand(1)*2*np.pi
-                eta_init[k,:]=np.zeros(npart)
-            else:
-                thet_init[k,:]=make_theta(npart,N_real[k])
-                eta_init[k,:]=make_eta(eta_step[k],npart,hist_rule)
+        filled=N_real!=0
+        if loading=='hammersley':
+            thet_init[...],_ = load_quiet(npart,0,0,iopt,N_real)
+            x_eta=np.broadcast_to(hammersley(npart,2),(np.count_nonzero(filled),npart))  # low-discrepancy points for the inverse cdf
+        elif rng_compat:
+            x_eta=np.zeros((s_steps,npart))
+            for k in range(s_steps):                                    # only the draws stay slice by slice
+                if N_real[k]==0:
+                    thet_init[k,:]=np.random.rand(1)*2*np.pi
+                else:
+                    thet_init[k,:]=make_theta(npart,N_real[k])
+                    x_eta[k,:]=np.random.rand(npart)
+            x_eta=x_eta[filled]
+        else:
+            x_thet=np.random.rand(s_steps,npart)
+            x_eta=np.random.rand(s_steps,npart)[filled]
+            thet_init[~filled,:]=2*np.pi*np.random.rand(np.count_nonzero(~filled),1)
+            thet_init[filled,:]=make_theta(npart,N_real[filled],x_thet[filled])
+        if isinstance(particle_position,dict):
+            eta_init[filled,:]=sample_eta_cdf(*fine_histogram_cdf(particle_position,hist_rule),x_eta)
+        else:
+            eta_init[filled,:]=make_eta_batch(eta_sorted,np.append(segment[:-1][filled],segment[-1]),npart,hist_rule,x_eta)
 
     return {'thet_init':thet_init,'eta_init':eta_init,'N_real':N_real,'s_steps':s_steps}
 
 
 
 
-def load_bucket(n,gbar,delg,iopt,Ns):
+def set_bucket_cache(max_bytes):
+    '''
+    bound the memory kept by the bucket cache, evicting the least recently used buckets; 0 empties it
+    '''
+    bucket_cache['max_bytes']=int(max_bytes)
+    cache_evict()
+
+
+def clear_bucket_cache():
+    bucket_cache['entries'].clear()
+    bucket_cache['nbytes']=0
+
+
+def cache_store(key,data,state):
+    '''
+    keep a read-only copy of the loaded buckets with the random generator state after loading
+    '''
+    data={name:np.array(value) if isinstance(value,np.ndarray) else value for name,value in data.items()}
+    nbytes=sum(value.nbytes for value in data.values() if isinstance(value,np.ndarray))
+    if nbytes>bucket_cache['max_bytes']:
+        return
+    for value in data.values():
+        if isinstance(value,np.ndarray):
+            value.setflags(write=False)
+    bucket_cache['entries'][key]=(data,state)
+    bucket_cache['nbytes']+=nbytes
+    cache_evict()
+
+
+def cache_evict():
+    entries=bucket_cache['entries']
+    while entries and bucket_cache['nbytes']>bucket_cache['max_bytes']:
+        key,(data,state)=entries.popitem(last=False)
+        bucket_cache['nbytes']-=sum(value.nbytes for value in data.values() if isinstance(value,np.ndarray))
+
+
+def bucket_key(*inputs):
+    '''
+    hash of the loading inputs: numbers by their repr, arrays (also inside dicts and tuples,
+    e.g. streamed particles or the random generator state) by dtype, shape and content
+    '''
+    h=hashlib.blake2b(digest_size=20)
+    def feed(value):
+        if isinstance(value,np.ndarray):
+            h.update(repr((value.dtype.str,value.shape)).encode())
+            h.update(np.ascontiguousarray(value).tobytes())
+        elif isinstance(value,dict):
+            for name in sorted(value):
+                h.update(repr(name).encode())
+                feed(value[name])
+        elif isinstance(value,(tuple,list)):
+            h.update(b'(')
+            for item in value:
+                feed(item)
+            h.update(b')')
+        else:
+            h.update(repr(value).encode())
+        h.update(b';')
+    for value in inputs:
+        feed(value)
+    return h.hexdigest()
+
+
+def slice_steps(particle_position,coopLength,dels,s_steps):
+    '''
+    number of slices the loaded beam is split into
+    s_steps from the input when particle_position is None, otherwise the slices covering the particles
+    '''
+    if particle_position is None:
+        return s_steps
+    if isinstance(particle_position,dict):
+        return particle_position['N_input'].shape[0]
+    return int(np.floor_divide(np.max(particle_position[:,0]),dels*coopLength))+1
+
+
+def load_bucket(n,gbar,delg,iopt,Ns,nbucket=None):
     '''
     random initialization of the beam load_bucket
     inputs:
@@ -66,9 +191,12 @@ def load_bucket(n,gbar,delg,iopt,Ns):
     delg            # Gaussian energy spread in units of rho
     iopt            # 'sase' or 'seeded'
     Ns              # N electrons per s-slice
+    nbucket         # None for one bucket, otherwise the number of buckets loaded with one random call
     outputs:
-    thet            # bucket macro particles position
-    eta             # bucket macro particles relative energy
+    thet            # bucket macro particles position, shape (n,) or (nbucket, n)
+    eta             # bucket macro particles relative energy, same shape as thet
+    the random numbers are drawn beamlet after beamlet, bucket after bucket, in the
+    same order as one np.random.rand(1) call per number
     '''
     nmax = 10000;
     if n>nmax:
@@ -76,62 +204,112 @@ def load_bucket(n,gbar,delg,iopt,Ns):
 
     #print('load random bucket!!!')
 
-    eta=np.zeros(n)
-    thet=np.zeros(n)
+    lead=() if nbucket is None else (nbucket,)
+    eta=np.zeros(lead+(n,))
+    thet=np.zeros(lead+(n,))
     if iopt=='seeded':
         M=128                                               # number of particles in each beamlet
         nb= int(np.round(n/M))                              # number of beamlet via Fawley between 64 to 256 (x16=1024 to 4096)
         if M*nb!=n:
             raise ValueError('n must be a multiple of 4')
-        for i in range(nb):
-            #etaa=delg*np.random.randn(1)+gbar
-            etaa=delg*(np.random.rand(1)-0.5)+gbar
-            for j in range(M):
-                eta[i*M+j]=etaa
-                thet[i*M+j]=2*np.pi*(j+1)/M
+        #etaa=delg*np.random.randn(1)+gbar
+        etaa=delg*(np.random.rand(*lead,nb)-0.5)+gbar
+        eta[...]=np.repeat(etaa,M,axis=-1)
+        thet[...]=np.tile(2*np.pi*np.arange(1,M+1)/M,nb)
     elif iopt=='sase':
         M=32  # number of particles in each beamlet
         nb= int(np.round(n/M) )    #number of beamlet via Fawley between 64 to 256 (x16=1024 to 4096)
         if M*nb!=n:
             raise ValueError('n must be a multiple of 4')
         effnoise = np.sqrt(3*M/(Ns/nb))    # Penman algorithm for Ns/nb >> M
-        for i in range(nb):
-            #etaa=delg*np.random.randn(1)+gbar
-            etaa=delg*(np.random.rand(1)-0.5)+gbar
-            for j in range(M):
-                eta[i*M+j]=etaa
-                thet[i*M+j]=2*np.pi*(j+1)/M+2*np.random.rand(1)*effnoise
+        r=np.random.rand(*lead,nb,M+1)                      # per beamlet: its energy, then the M phase kicks
+        #etaa=delg*np.random.randn(1)+gbar
+        etaa=delg*(r[...,0]-0.5)+gbar
+        eta[...]=np.repeat(etaa,M,axis=-1)
+        thet[...]=(2*np.pi*np.arange(1,M+1)/M+2*r[...,1:]*effnoise).reshape(lead+(n,))
     return thet,eta
 
-def make_theta(n,N_real_bucket):
+def load_quiet(n,gbar,delg,iopt,Ne):
+    '''
+    quiet start initialization of buckets on a Hammersley set
+    inputs:
+    n               # n-macro-particles per bucket
+    gbar            # scaled detune parameter
+    delg            # Gaussian energy spread in units of rho
+    iopt            # 'sase' adds the shot noise, 'seeded' stays quiet
+    Ne              # real number of electrons of every bucket, shape (nbucket,)
+    outputs:
+    thet            # buckets macro particles position, shape (nbucket, n)
+    eta             # buckets macro particles relative energy, shape (nbucket, n)
+    the phases are evenly spaced and the energies follow the base 2 radical inverse, so the
+    bucket starts with no bunching at all; the shot noise is then one random harmonic
+    displacement per bucket whose bunching has the statistics of Ne electrons
+    '''
+    Ne=np.asarray(Ne,dtype=float)
+    thet0=2*np.pi*np.arange(n)/n
+    eta0=delg*(hammersley(n,2)-0.5)+gbar
+    thet=np.tile(thet0,Ne.shape+(1,))
+    eta=np.tile(eta0,Ne.shape+(1,))
+    if iopt=='sase':
+        thet+=shot_noise(thet0,Ne)
+    return thet,eta
+
+def hammersley(n,base):
+    '''
+    radical inverse of 0..n-1 in the given base, i.e. one coordinate of an n point Hammersley
+    set (vectorized form of other/Lutman_MatlabSASE1D/i_to_hammersley_sequence.m)
+    '''
+    i=np.arange(n)
+    r=np.zeros(n)
+    scale=1.0/base
+    while np.any(i):
+        r+=(i%base)*scale
+        i//=base
+        scale/=base
+    return r
+
+def shot_noise(thet0,Ne):
+    '''
+    phase displacements 2|b|sin(thet0-phi) for quiet buckets at thet0: to first order they give
+    the bucket a bunching of modulus |b|, with |b|^2 exponential of mean 1/Ne and phi uniform
+    buckets with Ne=0 are left quiet
+    '''
+    u=np.random.rand(*Ne.shape,2)
+    amp=np.sqrt(-np.log(1-u[...,0])/np.where(Ne>0,Ne,np.inf))
+    phi=2*np.pi*u[...,1]
+    return 2*amp[...,np.newaxis]*np.sin(thet0-phi[...,np.newaxis])
+
+def make_theta(n,N_real_bucket,x=None):
     '''
     random initialization of a bucket's particle positions
     inputs:
     n               # n-macro-particles per bucket
-    N_real_bucket   # real number of particles in a bucket
+    N_real_bucket   # real number of particles in a bucket, scalar or one per bucket
+    x               # optional uniform random numbers, shape N_real_bucket.shape+(n,), drawn here if None
     outputs:
-    thet            # macro particles position in a bucket
+    thet            # macro particles position in a bucket, shape N_real_bucket.shape+(n,)
     '''
     
-    thet=np.zeros(n)
     M=32  # number of particles in each beamlet
     nb= int(np.round(n/M) )    #number of beamlet via Fawley between 64 to 256 (x16=1024 to 4096)
     if M*nb!=n:
         raise ValueError('n must be a multiple of 4')
         
+    N_real_bucket=np.asarray(N_real_bucket)
     effnoise = np.sqrt(3*M/(N_real_bucket/nb))    # Penman algorithm for Ns/nb >> M
-    for i in range(nb):       
-        for j in range(M):
-            thet[i*M+j]=2*np.pi*(j+1)/M+2*np.random.rand(1)*effnoise
+    if x is None:
+        x=np.random.rand(*N_real_bucket.shape,n)
+    thet=2*np.pi*np.tile(np.arange(1,M+1),nb)/M+2*x*effnoise[...,np.newaxis]
     return thet
 
 
 
-def make_eta(eta_step_bucket,npart,hist_rule='square-root'):
+def make_eta(eta_step_bucket,npart,hist_rule='square-root',x=None):
     '''
     eta_step_bucket     # input particles' eta values in a bucket
     npart               # n-macro-particles per bucket
     hist_rule          # different rules to select number of intervals to generate the histogram of eta value in a bucket
+    x                   # optional uniform random numbers (npart,) for the inverse cdf, drawn here if None
     outputs:
     eta_sampled         # sampled macro particles relative energy in a bucket
     '''
@@ -139,14 +317,9 @@ def make_eta(eta_step_bucket,npart,hist_rule='square-root'):
     lowbound=np.min(eta_step_bucket)
     upbound=np.max(eta_step_bucket)+1e-10
     pts=len(eta_step_bucket)
-    if hist_rule == 'square-root':
-        hist_num=int(np.sqrt(pts))
-    elif hist_rule=='sturges':
-        hist_num=int(np.log2(pts))+1
-    elif hist_rule=='rice-rule':
-        hist_num=int(2*pts**(1/3))
+    hist_num=int(hist_bins(pts,hist_rule))
     eta_hist=np.zeros(hist_num)
-    eta_hist,bins=np.histogram(np.array(eta_step_bucket),bins=np.linspace(lowbound, upbound, num=hist_num+1))
+    eta_hist,bins=np.histogram(eta_step_bucket,bins=np.linspace(lowbound, upbound, num=hist_num+1))
         #plt.figure()
         #_=plt.hist(np.array(eta_step_bucket),bins=np.linspace(lowbound, upbound, num=hist_num+1))
         #plt.title('Input eta histogram')
@@ -160,7 +333,8 @@ def make_eta(eta_step_bucket,npart,hist_rule='square-root'):
     eta_cdf=np.concatenate((np.zeros(1),eta_cdf))
         
     #make eta
-    x=np.random.rand(npart)
+    if x is None:
+        x=np.random.rand(npart)
     eta_sampled=np.interp(x, eta_cdf, bins)
         #plt.figure()
         #_=plt.hist(eta_sampled,bins=np.linspace(lowbound, upbound, num=hist_num+1))
@@ -168,3 +342,147 @@ def make_eta(eta_step_bucket,npart,hist_rule='square-root'):
     return eta_sampled
 
 
+def make_eta_batch(eta_sorted,segment,npart,hist_rule='square-root',x=None):
+    '''
+    make_eta for many buckets at once
+    inputs:
+    eta_sorted          # input particles' eta values, grouped bucket by bucket
+    segment             # bucket k holds eta_sorted[segment[k]:segment[k+1]], no bucket empty
+    npart               # n-macro-particles per bucket
+    hist_rule           # rule for the number of histogram intervals, as in make_eta
+    x                   # optional uniform random numbers (nbucket, npart) for the inverse cdf, drawn here if None
+    outputs:
+    eta_sampled         # sampled macro particles relative energy, shape (nbucket, npart)
+    for the same x the result is identical to make_eta bucket by bucket
+    '''
+    nbucket=segment.shape[0]-1
+    if x is None:
+        x=np.random.rand(nbucket,npart)
+    if nbucket==0:
+        return np.zeros((0,npart))
+    return sample_eta_cdf(*eta_histograms(eta_sorted,segment,hist_rule),x)
+
+
+def eta_histograms(eta_sorted,segment,hist_rule='square-root'):
+    '''
+    energy histograms of many buckets, stacked in one array padded to the largest number of
+    intervals so the cdfs are one cumulative sum along the interval axis
+    inputs:
+    eta_sorted          # input particles' eta values, grouped bucket by bucket
+    segment             # bucket k holds eta_sorted[segment[k]:segment[k+1]], no bucket empty
+    hist_rule           # rule for the number of histogram intervals, as in make_eta
+    outputs:
+    bins                # interval edges, shape (nbucket, hmax+1), padded with upbound
+    eta_cdf             # cdf at the edges, same shape as bins
+    hist_num            # number of intervals of every bucket
+    upbound             # upper edge of every bucket
+    '''
+    nbucket=segment.shape[0]-1
+    pts=np.diff(segment)
+    bucket=np.repeat(np.arange(nbucket),pts)
+    lowbound=np.minimum.reduceat(eta_sorted,segment[:-1])
+    upbound=np.maximum.reduceat(eta_sorted,segment[:-1])+1e-10
+    hist_num=hist_bins(pts,hist_rule)
+    hmax=np.max(hist_num)
+    bins,step=hist_edges(lowbound,upbound,hist_num)
+
+    #histogram: guess the interval from the step, then settle it against the edges like np.histogram
+    idx=np.clip(((eta_sorted-lowbound[bucket])/step[bucket]).astype(np.intp),0,hist_num[bucket]-1)
+    while True:
+        down=(idx>0)&(eta_sorted<bins[bucket,idx])
+        up=(idx<hist_num[bucket]-1)&(eta_sorted>=bins[bucket,idx+1])
+        if not (np.any(down) or np.any(up)):
+            break
+        idx=idx-down+up
+    eta_hist=np.bincount(bucket*hmax+idx,minlength=nbucket*hmax).reshape(nbucket,hmax)
+    eta_hist=eta_hist/np.sum(eta_hist,axis=1)[:,np.newaxis]
+
+    #make cdf
+    eta_cdf=np.concatenate((np.zeros((nbucket,1)),np.cumsum(eta_hist,axis=1)),axis=1)
+    return bins,eta_cdf,hist_num,upbound
+
+
+def fine_histogram_cdf(particle_hist,hist_rule='square-root'):
+    '''
+    eta_histograms for particles streamed by particle_stream.stream_particles: every filled
+    bucket's fine histogram on the shared grid is rebinned to the hist_rule intervals
+    between the bucket's own min and max, assuming a flat density inside each fine interval
+    inputs:
+    particle_hist       # dict returned by particle_stream.stream_particles
+    hist_rule           # rule for the number of histogram intervals, as in make_eta
+    outputs:
+    bins, eta_cdf, hist_num, upbound of the filled buckets, as in eta_histograms
+    '''
+    filled=particle_hist['N_input']!=0
+    pts=particle_hist['N_input'][filled]
+    fine_edges=particle_hist['fine_edges']
+    fine_counts=particle_hist['fine_counts'][filled]
+    lowbound=particle_hist['eta_min'][filled]
+    upbound=particle_hist['eta_max'][filled]+1e-10
+    hist_num=hist_bins(pts,hist_rule)
+    bins,step=hist_edges(lowbound,upbound,hist_num)
+
+    #fine cdf interpolated at the edges
+    fine_cdf=np.concatenate((np.zeros((pts.shape[0],1)),np.cumsum(fine_counts,axis=1)),axis=1)/pts[:,np.newaxis]
+    nfine=fine_edges.shape[0]-1
+    pos=np.clip(np.searchsorted(fine_edges,bins,side='right')-1,0,nfine-1)
+    frac=np.clip((bins-fine_edges[pos])/(fine_edges[pos+1]-fine_edges[pos]),0,1)
+    row=np.arange(pts.shape[0])[:,np.newaxis]
+    eta_cdf=fine_cdf[row,pos]+frac*(fine_cdf[row,pos+1]-fine_cdf[row,pos])
+    eta_cdf[:,0]=0
+    eta_cdf[np.arange(eta_cdf.shape[1])>=hist_num[:,np.newaxis]]=1
+    return bins,eta_cdf,hist_num,upbound
+
+
+def hist_edges(lowbound,upbound,hist_num):
+    '''
+    interval edges of np.linspace(lowbound, upbound, num=hist_num+1) for every bucket,
+    padded with upbound to the largest hist_num; returns the edges and the steps
+    '''
+    col=np.arange(np.max(hist_num)+1)
+    step=(upbound-lowbound)/hist_num
+    bins=col*step[:,np.newaxis]+lowbound[:,np.newaxis]
+    bins=np.where(col[np.newaxis,:]>=hist_num[:,np.newaxis],upbound[:,np.newaxis],bins)
+    return bins,step
+
+
+def sample_eta_cdf(bins,eta_cdf,hist_num,upbound,x):
+    '''
+    inverse cdf sampling of stacked histograms, np.interp(x, eta_cdf, bins) row by row
+    all samples come from one search, rows kept apart by an offset of 2
+    '''
+    nbucket,hmax=bins.shape[0],bins.shape[1]-1
+    row=np.arange(nbucket)[:,np.newaxis]
+    j=np.searchsorted((eta_cdf+2*row).ravel(),(x+2*row).ravel(),side='right').reshape(x.shape)-1-row*(hmax+1)
+    j=np.clip(j,0,hmax)
+    while True:                                                         # undo rounding of the offset
+        down=(j>0)&(x<eta_cdf[row,j])
+        up=(j<hmax)&(x>=eta_cdf[row,np.minimum(j+1,hmax)])
+        if not (np.any(down) or np.any(up)):
+            break
+        j=j-down+up
+    inside=j<hist_num[:,np.newaxis]
+    j=np.minimum(j,hist_num[:,np.newaxis]-1)
+    x0=eta_cdf[row,j]
+    x1=eta_cdf[row,j+1]
+    y0=bins[row,j]
+    y1=bins[row,j+1]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        eta_sampled=(y1-y0)/(x1-x0)*(x-x0)+y0
+    eta_sampled=np.where(x==x0,y0,eta_sampled)
+    eta_sampled=np.where(inside,eta_sampled,upbound[:,np.newaxis])
+    return eta_sampled
+
+
+def hist_bins(pts,hist_rule):
+    '''
+    number of histogram intervals for pts particles under hist_rule, elementwise
+    '''
+    pts=np.asarray(pts)
+    if hist_rule == 'square-root':
+        return np.sqrt(pts).astype(int)
+    elif hist_rule=='sturges':
+        return np.log2(pts).astype(int)+1
+    elif hist_rule=='rice-rule':
+        return (2*pts**(1/3)).astype(int)
+    raise ValueError('unknown hist_rule '+str(hist_rule))
@@ -0,0 +1,73 @@
+import numpy as np
+from zfel.sase1d_input_part import alfvenCurrent, mc2, c, e, undulator_coupling
+
+
+def mingxie(energy,eSpread,emitN,currentMax,beta,unduPeriod,unduK,**kwargs):
+    '''
+    Ming Xie estimate of the 3D gain length, saturation length and power, taking the
+    sase() inputs and broadcasting over any grid of them
+    (M. Xie, Design Optimization for an X-ray Free Electron Laser Driven by SLAC Linac, PAC 1995;
+    the scalar version is old_scripts/mingxie.py)
+    inputs:
+    energy              # electron energy [eV]
+    eSpread             # relative rms energy spread [ ]
+    emitN               # normalized transverse emittance [m-rad]
+    currentMax          # peak current [Ampere]
+    beta                # mean beta [meter]
+    unduPeriod          # undulator period [meter]
+    unduK               # undulator parameter along z on the last axis, as in inp_struct; the entrance
+                        # value is used, so a grid of K values needs a trailing axis (e.g. K[:,np.newaxis])
+    kwargs              # the other inp_struct entries, ignored
+    outputs as dict, broadcast over the inputs:
+    gain_length         # 3D gain length [m]
+    saturation_length   # saturation length [m]
+    saturation_power    # saturation power [W]
+    fel_wavelength      # resonant wavelength [m]
+    pierce_parameter    # FEL Pierce parameter rho
+    '''
+    unduK=np.asarray(unduK)[...,0]
+    gamma0=np.asarray(energy)/mc2
+    emittance=np.asarray(emitN)/gamma0
+    sigmaX2=emittance*beta                                  # rms transverse size squared, as in params_calc
+    unduJJ=undulator_coupling(unduK,gamma0)[0]
+
+    felwave=unduPeriod*(1+unduK**2/2)/(2*gamma0**2)
+    rho=(0.5/gamma0)*((currentMax/alfvenCurrent)*(unduPeriod*unduK*unduJJ/(2*np.pi))**2/(2*sigmaX2))**(1/3)
+
+    L1d=unduPeriod/(4*np.pi*rho*np.sqrt(3))                 # 1D gain length
+    Lr=4*np.pi*sigmaX2/felwave                              # Rayleigh length
+
+    yd=L1d/Lr                                               # Xie's three scaled parameters
+    yr=4*np.pi*L1d*eSpread/unduPeriod
+    ye=4*np.pi*L1d/beta*emittance/felwave
+    y=0.45*yd**0.57+0.55*ye**1.6+3*yr**2+0.35*ye**2.9*yr**2.4+51*yd**0.95*yr**3\
+      +5.4*yd**0.7*ye**1.9+1140*yd**2.2*ye**2.9*yr**3.2
+    Lg=(1+y)*L1d
+
+    Pbeam=currentMax*energy
+    Psat=1.6*rho*(L1d/Lg)**2*Pbeam
+    alpha=1/9
+    Pn=rho**2*energy*e*c/felwave                            # shot noise power
+    Lsat=Lg*np.log(Psat/Pn/alpha)
+
+    return {'gain_length':Lg,'saturation_length':Lsat,'saturation_power':Psat,\
+            'fel_wavelength':felwave,'pierce_parameter':rho}
+
+
+def prescreen(inp_structs,lsat_range=(0.0,1.5)):
+    '''
+    Ming Xie pre-screen of scan configurations before any FEL_process time is spent on them
+    inputs:
+    inp_structs         # list of sase() input dicts
+    lsat_range          # kept saturation lengths, as fractions of each configuration's unduL
+    outputs:
+    keep                # boolean mask of the configurations whose saturation length is in range
+    estimate            # mingxie() outputs, one entry per configuration
+    '''
+    keys=['energy','eSpread','emitN','currentMax','beta','unduPeriod','unduL']
+    grid={key:np.array([inp_struct[key] for inp_struct in inp_structs],dtype=float) for key in keys}
+    grid['unduK']=np.array([np.atleast_1d(inp_struct['unduK'])[0] for inp_struct in inp_structs])[:,np.newaxis]
+    estimate=mingxie(**grid)
+    Lsat=estimate['saturation_length']
+    keep=(Lsat>=lsat_range[0]*grid['unduL'])&(Lsat<=lsat_range[1]*grid['unduL'])
+    return keep,estimate
@@ -0,0 +1,148 @@
+import os
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+def open_sink(path,shapes,block=64,compression='gzip',mode='w'):
+    '''
+    output sink on disk for the large result grids, filled while the run goes
+    inputs:
+    path                # .h5/.hdf5 file for chunked, compressed HDF5 datasets (needs h5py),
+                        # anything else is a directory of .npy files written through memory maps
+    shapes              # {name: (shape, dtype)} of the datasets to create
+    block               # rows or columns buffered in memory before they are written out
+    compression         # HDF5 compression filter, None to store uncompressed
+    mode                # 'w' to create the datasets, 'r+' to reopen those of an earlier sink on path
+                        # and go on writing into them (restart from a checkpoint)
+    outputs:
+    sink                # dict with the open datasets, the write buffers and the file handle
+    '''
+    sink={'path':path,'file':None,'datasets':{},'buffers':{},'block':int(block)}
+    if is_hdf5(path):
+        if h5py is None:
+            raise ImportError('h5py is needed to write the results to '+path)
+        try:
+            sink['file']=h5py.File(path,mode)
+        except OSError as err:
+            raise OSError(str(path)+' cannot be written, it may still be open through the lazy results of an earlier run;'\
+                          " close them first, e.g. history['power_s'].file.close()") from err
+        if mode=='r+':
+            sink['datasets']={name:sink['file'][name] for name in sink['file']}
+            return sink
+        for name,(shape,dtype) in shapes.items():
+            chunks=tuple(min(n,block) if i>=len(shape)-2 else 1 for i,n in enumerate(shape))
+            sink['datasets'][name]=sink['file'].create_dataset(name,shape=shape,dtype=dtype,\
+                                                               chunks=chunks if all(chunks) else None,compression=compression)
+    elif mode=='r+':
+        for name in shapes:
+            sink['datasets'][name]=np.load(os.path.join(path,name+'.npy'),mmap_mode='r+')
+    else:
+        os.makedirs(path,exist_ok=True)
+        for name,(shape,dtype) in shapes.items():
+            sink['datasets'][name]=np.lib.format.open_memmap(os.path.join(path,name+'.npy'),mode='w+',dtype=dtype,shape=shape)
+    return sink
+
+
+def memory_sink(shapes):
+    '''
+    sink holding the grids as plain zero-filled arrays, written without buffering
+    '''
+    return {'path':None,'file':None,'datasets':{name:np.zeros(shape,dtype=dtype) for name,(shape,dtype) in shapes.items()},\
+            'buffers':{},'block':None}
+
+
+def sink_write(sink,name,axis,index,value):
+    '''
+    write value at position index along axis of dataset name; the writes of one dataset
+    must come in increasing index, a block of them is collected before going to disk
+    '''
+    dataset=sink['datasets'][name]
+    axis=axis%dataset.ndim
+    if sink['block'] is None:
+        dataset[(slice(None),)*axis+(index,)]=value
+        return
+    buffer=sink['buffers'].get(name)
+    if buffer is not None and index>=buffer['start']+sink['block']:
+        flush_buffer(sink,name)
+        buffer=None
+    if buffer is None:
+        shape=list(dataset.shape)
+        shape[axis]=sink['block']
+        buffer={'data':np.zeros(shape,dtype=dataset.dtype),'axis':axis,'start':index,'stop':index}
+        sink['buffers'][name]=buffer
+    buffer['data'][(slice(None),)*axis+(index-buffer['start'],)]=value
+    buffer['stop']=index+1
+
+
+def flush_buffer(sink,name):
+    buffer=sink['buffers'].pop(name)
+    axis=buffer['axis']
+    count=buffer['stop']-buffer['start']
+    sink['datasets'][name][(slice(None),)*axis+(slice(buffer['start'],buffer['stop']),)]=\
+        buffer['data'][(slice(None),)*axis+(slice(0,count),)]
+
+
+def sink_flush(sink):
+    '''
+    write out every pending buffer
+    '''
+    for name in list(sink['buffers']):
+        flush_buffer(sink,name)
+    if sink['file'] is not None:
+        sink['file'].flush()
+    for dataset in sink['datasets'].values():
+        if isinstance(dataset,np.memmap):
+            dataset.flush()
+
+
+def sink_store(sink,name,value):
+    '''
+    store a whole array, creating the dataset if needed (small outputs such as power_z)
+    '''
+    value=np.asarray(value)
+    if name in sink['datasets'] and sink['datasets'][name].shape!=value.shape and sink['file'] is not None:
+        del sink['file'][name]                                              # left by an earlier run into the file
+        del sink['datasets'][name]
+    if name in sink['datasets']:
+        sink['datasets'][name][...]=value
+    elif sink['file'] is not None:
+        sink['datasets'][name]=sink['file'].create_dataset(name,data=value)
+    elif sink['path'] is not None:
+        np.save(os.path.join(sink['path'],name+'.npy'),value)
+    else:
+        sink['datasets'][name]=value.copy()
+
+
+def close_sink(sink):
+    '''
+    flush and close the sink, returns its path
+    '''
+    sink_flush(sink)
+    sink['datasets'].clear()
+    if sink['file'] is not None:
+        sink['file'].close()
+    return sink['path']
+
+
+def open_results(path):
+    '''
+    open the results written by a run lazily: h5py datasets of the read-only file,
+    or read-only memory maps of the .npy files
+    outputs:
+    results             # {name: dataset}, data is only read when indexed
+    '''
+    if is_hdf5(path):
+        if h5py is None:
+            raise ImportError('h5py is needed to read '+path)
+        handle=h5py.File(path,'r')
+        return {name:handle[name] for name in handle}
+    return {name[:-4]:np.load(os.path.join(path,name),mmap_mode='r')
+            for name in sorted(os.listdir(path)) if name.endswith('.npy')}
+
+
+def is_hdf5(path):
+    return str(path).endswith(('.h5','.hdf5'))
@@ -0,0 +1,104 @@
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+def stream_particles(source,coopLength,dels,dataset=None,chunk=2**20,nfine=1024):
+    '''
+    one pass over a particle distribution too large for memory, accumulating what
+    general_load_bucket needs: the particle count, energy range and a fine energy
+    histogram of every slice; pass the result as particle_position
+    inputs:
+    source              # .npy file (memory mapped), .h5/.hdf5 file, or an array-like of shape (N, 2)
+                        # sliceable by rows (np.memmap, h5py.Dataset), or a pair (s, eta) of 1-D array-likes
+                        # such as two openPMD record components; positions in meter, eta relative energy
+    coopLength          # cooperation length, as returned by params_calc
+    dels                # integration step in s0, as returned by params_calc
+    dataset             # dataset name inside an HDF5 file, or a pair of names for s and eta
+    chunk               # number of particles read at a time
+    nfine               # number of intervals of the fine energy grid shared by all slices (even)
+    outputs:
+    particle_hist       # dict with
+                        #   N_input       particles in every slice, shape (s_steps,)
+                        #   eta_min       smallest eta of every slice (inf if empty)
+                        #   eta_max       largest eta of every slice (-inf if empty)
+                        #   fine_edges    edges of the fine energy grid, shape (nfine+1,)
+                        #   fine_counts   particles of every slice in every fine interval, shape (s_steps, nfine)
+                        #   slice_length  slice length in meter the particles were sorted with
+    the fine grid starts on the energy range of the first chunk and doubles its width,
+    merging neighbouring intervals, whenever a later chunk falls outside it; the slice
+    histograms of hist_rule are rebinned from it when the buckets are loaded
+    '''
+    if nfine%2:
+        raise ValueError('nfine must be even')
+    slice_length=dels*coopLength
+    handle=None
+    if isinstance(source,str):
+        if source.endswith('.npy'):
+            source=np.load(source,mmap_mode='r')
+        else:
+            if h5py is None:
+                raise ImportError('h5py is needed to stream particles from '+source)
+            handle=h5py.File(source,'r')
+            if isinstance(dataset,(tuple,list)):
+                source=(handle[dataset[0]],handle[dataset[1]])
+            else:
+                source=handle[dataset]
+    try:
+        if isinstance(source,(tuple,list)):
+            npoints=source[0].shape[0]
+            read=lambda i0,i1: (np.asarray(source[0][i0:i1],dtype=float),np.asarray(source[1][i0:i1],dtype=float))
+        else:
+            npoints=source.shape[0]
+            read=lambda i0,i1: tuple(np.asarray(source[i0:i1],dtype=float).T)
+
+        fine_counts=np.zeros((0,nfine),dtype=np.int64)
+        eta_min=np.zeros(0)
+        eta_max=np.zeros(0)
+        lowest=None
+        width=None
+        for i0 in range(0,npoints,chunk):
+            s_chunk,eta_chunk=read(i0,min(i0+chunk,npoints))
+            if s_chunk.shape[0]==0:
+                continue
+            location=np.floor_divide(s_chunk,slice_length).astype(np.intp)
+            if np.min(location)<0:
+                raise ValueError('particle positions must not be negative')
+            low,high=np.min(eta_chunk),np.max(eta_chunk)
+
+            #grow the slices and the fine grid to cover the chunk
+            ns=max(fine_counts.shape[0],int(np.max(location))+1)
+            if ns>fine_counts.shape[0]:
+                grow=ns-fine_counts.shape[0]
+                fine_counts=np.concatenate((fine_counts,np.zeros((grow,nfine),dtype=np.int64)))
+                eta_min=np.concatenate((eta_min,np.full(grow,np.inf)))
+                eta_max=np.concatenate((eta_max,np.full(grow,-np.inf)))
+            if lowest is None:
+                span=max(high-low,abs(low)*1e-12,1e-300)
+                lowest=low-0.01*span
+                width=1.02*span/nfine
+            while low<lowest or high>=lowest+nfine*width:
+                fine_counts=fine_counts.reshape(ns,nfine//2,2).sum(axis=2)
+                pad=np.zeros((ns,nfine//2),dtype=np.int64)
+                if low<lowest:
+                    fine_counts=np.concatenate((pad,fine_counts),axis=1)
+                    lowest=lowest-nfine*width
+                else:
+                    fine_counts=np.concatenate((fine_counts,pad),axis=1)
+                width=2*width
+
+            idx=np.clip(np.floor((eta_chunk-lowest)/width).astype(np.intp),0,nfine-1)
+            fine_counts+=np.bincount(location*nfine+idx,minlength=ns*nfine).reshape(ns,nfine)
+            np.minimum.at(eta_min,location,eta_chunk)
+            np.maximum.at(eta_max,location,eta_chunk)
+    finally:
+        if handle is not None:
+            handle.close()
+    if lowest is None:
+        raise ValueError('no particles in the source')
+
+    return {'N_input':np.sum(fine_counts,axis=1),'eta_min':eta_min,'eta_max':eta_max,\
+            'fine_edges':lowest+width*np.arange(nfine+1),'fine_counts':fine_counts,'slice_length':slice_length}
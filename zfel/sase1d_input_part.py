@@ -1,8 +1,16 @@
+import os
 import numpy as np
 import scipy
 from scipy import special
+import scipy.fft
+import scipy.signal
 from zfel import general_load_bucket
+from zfel import fel_numba
+from zfel import wavefront
+from zfel import output_sink
+from zfel import checkpoint
 import matplotlib.pyplot as plt 
+import warnings
 
 # Some constant values
 alfvenCurrent = 17045.0 # Alfven current ~ 17 kA
@@ -12,12 +20,21 @@ e = 1.60217733E-19      # electron charge in Coulomb
 epsilon_0=8.85418782E-12 #electric constant
 hbar=6.582e-16          #in eV
 
+# Input options of sase(), as documented there
+inp_options = ('Nruns','npart','s_steps','z_steps','energy','eSpread','emitN','currentMax','beta','unduPeriod',\
+               'unduK','unduL','radWavelength','dEdz','iopt','P0','constseed','particle_position','hist_rule',\
+               'rng_compat','loading','bucket_cache','engine','nworkers','z_chunk','record_z','record_slices','dtype',\
+               'power_s_out','power_z_out','field_s_out','spectrum_z','spectrum_nfft','spectrum_window','fft_workers',\
+               'output_file','output_block','output_compression','checkpoint_dir','checkpoint_every',\
+               'taper','taper_phase','taper_start','stop_after','stop_drop','stop_arm','slip_every','slippage',\
+               'integrator','energy_balance','step_error')
 
-def sase(inp_struct):
+
+def sase(inp_struct,restart=None):
     '''
     SASE 1D FEL run function
     Input:
-    Nruns                       # Number of runs
+    Nruns                       # Number of runs, independent shot-noise realizations advanced together along a leading run axis
     npart                       # n-macro-particles per bucket 
     s_steps                     # n-sample points along bunch length
     z_steps                     # n-sample points along undulator
@@ -31,11 +48,66 @@ def sase(inp_struct):
     unduL                       # length of undulator [meter]
     radWavelength               # seed wavelength? [meter], used only in single-freuqency runs
     dEdz                        # rate of relative energy gain or taper [keV/m], optimal~130
-    iopt                        # 'sase' or 'seeded'
+    iopt                        # 'sase' or 'seeded'; 'seeded' is the steady state of a uniform beam: one periodic
+                                # bucket (particle_position unused, s_steps=1) amplifying the seed without slippage
     P0                          # small seed input power [W]
     constseed                   # whether we want to use constant  random seed for reproducibility, 1 Yes, 0 No
-    particle_position           # particle information with positions in meter and eta
+    particle_position           # particle information with positions in meter and eta, or the slice
+                                # histograms of particle_stream.stream_particles for files too large for memory
     hist_rule                   # different rules to select number of intervals to generate the histogram of eta value in a bucket
+    rng_compat                  # optional, True (default) keeps the historical random sequence when loading particle_position,
+                                # False draws every slice's random numbers in one call
+    loading                     # optional, 'beamlet' (default) or 'hammersley' for a quiet start with shot noise
+    bucket_cache                # optional, True to reuse buckets already loaded with the same inputs and seed,
+                                # e.g. across the points of a scan (general_load_bucket.set_bucket_cache bounds it)
+    engine                      # optional, 'slice' (default) to loop slice by slice, 'zmajor' to advance all slices together,
+                                # 'numba' for the compiled leap-frog (falls back to 'zmajor' without numba),
+                                # 'wavefront' to pipeline blocks of slices over worker processes
+    nworkers                    # optional, number of worker processes for engine='wavefront', default all cores
+    z_chunk                     # optional, z steps handed downstream at a time for engine='wavefront'
+    record_z                    # optional, z station indices (0..z_steps) where the phase space is recorded, default all
+    record_slices               # optional, recorded slices: None for the last one, 'all', a stride or a list of indices
+    dtype                       # optional, 'float64' (default) or 'float32' for particles, field grid and bunching
+    power_s_out, power_z_out, field_s_out   # optional preallocated arrays final_calc writes power_s, power_z, field_s into
+    spectrum_z                  # optional, z station indices (0..z_steps) for the spectrum, default the undulator exit
+    spectrum_nfft               # optional, FFT length for zero-padding, default s_steps
+    spectrum_window             # optional, window name (scipy.signal.get_window) applied along the bunch
+    fft_workers                 # optional, threads used by scipy.fft, default -1 for all cores
+    output_file                 # optional, .h5/.hdf5 file (or a directory of .npy files) the field grid, bunching,
+                                # power_s and field_s are written to while the run goes instead of kept in memory;
+                                # power_s, field_s and bunching are then returned as lazy datasets of that file, which
+                                # keep an HDF5 file open: close it (history['power_s'].file.close()) before another
+                                # run writes to the same file
+    output_block                # optional, rows or columns buffered before a write, default 64
+    output_compression          # optional, HDF5 compression filter, default 'gzip'
+    checkpoint_dir              # optional, directory the run's checkpoints are written to, resumed by sase_restart;
+                                # the run then goes on the 'zmajor' engine, and without output_file its field grid
+                                # is streamed to checkpoint_dir/grid so a restart finds the steps already done
+    checkpoint_every            # optional, z steps between checkpoints, default z_steps//10
+    taper                       # optional, 'resonant' to compute unduK on the fly keeping the resonant phase
+                                # taper_phase [rad] from taper_start [m] on (default 0), on the 'zmajor' engine;
+                                # the undulator parameter used is returned in history['taper_unduK']
+    stop_after                  # optional, stop the run this many meters past the power maximum, on the 'zmajor' engine
+    stop_drop                   # optional, stop the run once the power has dropped by this fraction from its maximum
+    stop_arm                    # optional, the stop criteria apply once the mean energy loss exceeds stop_arm*rho
+                                # (default 0.5); z, power_z, power_s and the other histories then end at the stop,
+                                # history['z_stop'] is the stop position [m] (None if the whole undulator was run);
+                                # grids stored in output_file keep their full z size, zero past the stop
+    slip_every                  # optional, slice spacing in z steps (default 1): dels=slip_every*delt, so the s grid
+                                # is slip_every times coarser than the z grid; runs on the 'zmajor' engine
+                                # (iopt='seeded' has no slippage, its field steps by delt whatever slip_every)
+    slippage                    # optional, 'step' (default) slips the field by one slice every slip_every z steps,
+                                # 'interp' by a fraction 1/slip_every of a slice every step (any slip_every>=1)
+    integrator                  # optional, 'leapfrog' (default) or 'yoshida4' for the 4th-order Yoshida composition
+                                # of symmetric drift/kick/drift steps on the 'zmajor' engine, for coarser z_steps
+    energy_balance              # optional, True to follow the field energy gained against the beam energy lost
+                                # (on the 'zmajor' engine); history['energy_balance'] is their running difference
+                                # relative to the largest beam energy loss, an accuracy measure of the leapfrog z step
+                                # ('yoshida4' keeps it to round-off by construction, use step_error there)
+    step_error                  # optional, True to carry a second solution along that takes every z step as two half
+                                # steps (on the 'zmajor' engine, about three times the cost); history['power_z_error']
+                                # is then the step doubling (Richardson) estimate of the error of power_z from the z step
+    restart                     # used by sase_restart: the loaded buckets, random generator state and checkpoint
 
     Output:
     z                           # longitudinal steps along undulator
@@ -51,35 +123,117 @@ def sase(inp_struct):
     thet_out                    # output phase
     eta_out                     # output energy in unit of mc2
     bunching                    # bunching factor
-    spectrum                    # spectrum power
-    freq                        # frequency in ev
+    spectrum                    # spectrum power along the bunch at the spectrum_z stations, shape (stations, nfft)
+    freq                        # photon energy in ev matching the spectrum
     Ns                          # real number of examples
+    history also holds thet_record/eta_record, the phase space snapshots at the recorded_z stations
+    for the recorded_slices, and etaavg, the average energy of the last slice along the undulator
+    with Nruns>1, power_z, power_s, field, field_s, spectrum, bunching and the phase space
+    histories get a leading run axis
     '''
+    check_inputs(inp_struct)
+
     #calculating intermediate parameters
     params=params_calc(**inp_struct)
     
     #loaduckets
+    resume=None
+    if restart is not None:
+        bucket_data,rng_state,resume=restart
+        np.random.set_state(rng_state)
+    else:
+        bucket_data=load_buckets(inp_struct,params)
+        if inp_struct.get('checkpoint_dir') is not None:
+            bucket_data['run_id']=checkpoint.save_inputs(inp_struct['checkpoint_dir'],inp_struct,bucket_data)
+    
+    #open the output sink, checkpointed runs keep their field grid on disk as well
+    sink=None
+    output_file=inp_struct.get('output_file')
+    if output_file is not None or inp_struct.get('checkpoint_dir') is not None:
+        lead=(inp_struct['Nruns'],) if inp_struct['Nruns']>1 else ()
+        shapes=grid_shapes(bucket_data['s_steps'],inp_struct['z_steps'],lead,inp_struct.get('dtype','float64'))
+        if output_file is not None:
+            shapes['power_s']=(lead+(inp_struct['z_steps'],bucket_data['s_steps']),shapes['Er'][1])
+            shapes['field_s']=(shapes['Er'][0],shapes['bunching'][1])
+        sink=output_sink.open_sink(output_file if output_file is not None else os.path.join(inp_struct['checkpoint_dir'],'grid'),\
+                                   shapes,block=inp_struct.get('output_block',64),\
+                                   compression=inp_struct.get('output_compression','gzip'),mode='w' if resume is None else 'r+')
+
+    try:
+        #FEL process
+        FEL_params={}
+        FEL_params.update(inp_struct)
+        FEL_params.update(params)
+        FEL_params.update(bucket_data)
+        FEL_params['sink']=sink
+        FEL_params['resume']=resume
+        FEL_data=FEL_process(**FEL_params)
+
+        #finalize calculation
+        final_params={}
+        final_params.update(FEL_data)
+        final_params.update(FEL_params)
+        if output_file is None:
+            final_params['sink']=None                                       # power_s and field_s stay in memory
+        if FEL_data['z_stop'] is not None:
+            #the run stopped early, convert the steps done
+            final_params['z_steps']=FEL_data['z'].shape[0]
+            stations=spectrum_stations(inp_struct.get('spectrum_z'),inp_struct['z_steps'])
+            final_params['spectrum_z']=stations[stations<=final_params['z_steps']] if inp_struct.get('spectrum_z') is not None else None
+        final_data=final_calc(**final_params)
+    except BaseException:
+        if sink is not None:
+            output_sink.close_sink(sink)
+        raise
+    if sink is not None and output_file is None:
+        #grid kept on disk for the checkpoints only, hand it back in memory
+        for name in ['Er','Ei','bunching']:
+            FEL_data[name]=np.array(FEL_data[name])
+        output_sink.close_sink(sink)
+    elif sink is not None:
+        #keep the small outputs next to the grids, then hand back lazy datasets
+        history=final_data['history']
+        for name in ['z','s','power_z','field','spectrum','freq','spectrum_z','etaavg',\
+                     'thet_record','eta_record','recorded_z','recorded_slices']:
+            output_sink.sink_store(sink,name,history[name])
+        results=output_sink.open_results(output_sink.close_sink(sink))
+        history['power_s']=results['power_s']
+        history['field_s']=results['field_s']
+        FEL_data['bunching']=results['bunching']
+
+    return sase_outputs(params,FEL_data,final_data)
+
+def check_inputs(inp_struct):
+    '''
+    raise TypeError on inp_struct keys that are not sase() options, so a misspelled option
+    is not silently left at its default
+    '''
+    unknown=sorted(set(inp_struct)-set(inp_options))
+    if unknown:
+        raise TypeError('unknown sase() inputs '+', '.join(unknown))
+
+def load_buckets(inp_struct,params):
+    '''
+    load the buckets of a run, with Nruns>1 one set per run stacked along a leading axis
+    '''
+    seeded=inp_struct['iopt']=='seeded'                                     # steady state, a single bucket
     bucket_params={'npart':inp_struct['npart']
         ,'Ns':params['Ns'],'coopLength':params['coopLength'],\
-        'particle_position':inp_struct['particle_position'],'s_steps':inp_struct['s_steps'],\
+        'particle_position':None if seeded else inp_struct['particle_position'],'s_steps':1 if seeded else inp_struct['s_steps'],\
         'dels':params['dels'],'hist_rule':inp_struct['hist_rule'],'gbar':params['gbar'],\
-        'delg':params['delg'],'iopt':inp_struct['iopt']}
+        'delg':params['delg'],'iopt':inp_struct['iopt'],'rng_compat':inp_struct.get('rng_compat',True),\
+        'loading':inp_struct.get('loading','beamlet'),'cache':inp_struct.get('bucket_cache',False)}
     bucket_data=general_load_bucket.general_load_bucket(**bucket_params)
-    
-    #FEL process
-    FEL_params={}
-    FEL_params.update(inp_struct)
-    FEL_params.update(params)
-    FEL_params.update(bucket_data)
-    FEL_data=FEL_process(**FEL_params)
-
-    #finalize calculation
-    final_params={}
-    final_params.update(FEL_data)
-    final_params.update(FEL_params)
-    final_data=final_calc(**final_params)
-
-    #unpack outputs
+    if inp_struct['Nruns']>1:
+        runs=[bucket_data]+[general_load_bucket.general_load_bucket(**bucket_params) for r in range(inp_struct['Nruns']-1)]
+        bucket_data['thet_init']=np.stack([run['thet_init'] for run in runs])
+        bucket_data['eta_init']=np.stack([run['eta_init'] for run in runs])
+    return bucket_data
+
+def sase_outputs(params,FEL_data,final_data):
+    '''
+    unpack the outputs of a run into the tuple returned by sase()
+    '''
     gainLength=params['gainLength']
     resWavelength=params['resWavelength']
     thet_out=final_data['thet_out']
@@ -100,23 +254,32 @@ def sase(inp_struct):
     field_s=history['field_s']
     return z,power_z,s,power_s,rho,detune,field,field_s,gainLength,resWavelength,thet_out,eta_out,bunching,spectrum,freq,Ns,history
 
+def sase_restart(checkpoint_dir):
+    '''
+    resume a sase() run from the latest checkpoint in checkpoint_dir (or from the start, with
+    the same buckets, if none was written yet); the field grid of the steps already done is
+    reopened where the run wrote it (output_file or checkpoint_dir/grid), the outputs are
+    identical to those of the uninterrupted run, and the run goes on writing checkpoints
+    to the same directory
+    '''
+    inp_struct,bucket_data,rng_state,resume=checkpoint.read_checkpoint(checkpoint_dir)
+    return sase(inp_struct,restart=(bucket_data,rng_state,resume))
+
 def params_calc(Nruns,npart,s_steps,z_steps,energy,eSpread,\
             emitN,currentMax,beta,unduPeriod,unduK,unduL,radWavelength,\
-            dEdz,iopt,P0,constseed,particle_position,hist_rule):
+            dEdz,iopt,P0,constseed,particle_position,hist_rule,slip_every=1,**kwargs):
     '''
     calculating intermediate parameters
+    slip_every          # slice spacing in z steps, the field slips over one slice every slip_every steps
+    kwargs holds the run options used by the later stages (e.g. engine)
     '''
     # whether to use constant random seed for reproducibility
     if constseed==1:
         np.random.seed(22)
-    unduJJ  = scipy.special.jv(0,unduK**2/(4+2*unduK**2))\
-              -scipy.special.jv(1,unduK**2/(4+2*unduK**2))  # undulator JJ
     gamma0  = energy/mc2                                    # central energy of the beam in unit of mc2
     sigmaX2 = emitN*beta/gamma0                             # rms transverse size, divergence of the electron beam
-
-    kappa_1=e*unduK*unduJJ/4/epsilon_0/gamma0
+    unduJJ,kappa_1,Kai=undulator_coupling(unduK,gamma0)
     density=currentMax/(e*c*2*np.pi*sigmaX2)
-    Kai=e*unduK*unduJJ/(2*gamma0**2*mc2*e)
     ku=2*np.pi/unduPeriod
 
 
@@ -133,12 +296,12 @@ def params_calc(Nruns,npart,s_steps,z_steps,energy,eSpread,\
     #cs0  = bunchLength/coopLength                           # bunch length in units of cooperation length     
     z0    = unduL#/gainLength                                # wiggler length in units of gain length
     delt  = z0/z_steps                                      # integration step in z0 ~ 0.1 gain length
-    dels  = delt                                            # integration step in s0 must be same as in z0 
+    dels  = slip_every*delt                                 # integration step in s0, slip_every z steps per slice
     E02   = density*kappa_1[0]*P0*1E-9/Pbeam/Kai[0]                              # scaled input power
     gbar  = (resWavelength-radWavelength)\
             /(radWavelength)                                # scaled detune parameter
     delg  = eSpread                                         # Gaussian energy spread in units of rho 
-    Ns    = currentMax*unduL/unduPeriod/z_steps\
+    Ns    = currentMax*unduL/unduPeriod/z_steps*slip_every\
             *resWavelength/c/e                              # N electrons per s-slice [ ]
     #Eloss = -dEdz*1E-3/energy/rho*gainLength                # convert dEdz to alpha parameter
     deta = np.sqrt((1+0.5*unduK[0]**2)/(1+0.5*unduK**2))-1
@@ -153,13 +316,64 @@ def params_calc(Nruns,npart,s_steps,z_steps,energy,eSpread,\
 
 
 
+def undulator_coupling(unduK,gamma0):
+    '''
+    undulator JJ and the field/particle couplings kappa_1 and Kai for the undulator parameter unduK
+    '''
+    unduJJ  = scipy.special.jv(0,unduK**2/(4+2*unduK**2))\
+              -scipy.special.jv(1,unduK**2/(4+2*unduK**2))  # undulator JJ
+    kappa_1=e*unduK*unduJJ/4/epsilon_0/gamma0
+    Kai=e*unduK*unduJJ/(2*gamma0**2*mc2*e)
+    return unduJJ,kappa_1,Kai
+
 def FEL_process(Nruns,npart,z_steps,energy,eSpread,\
             emitN,currentMax,beta,unduPeriod,unduK,unduL,radWavelength,\
             dEdz,iopt,P0,constseed,particle_position,hist_rule,\
             unduJJ,gamma0,sigmaX2,kappa_1,density,\
             Kai,ku,resWavelength,Pbeam,coopLength,z0,\
             delt,dels,E02,gbar,delg,Ns,deta,\
-            thet_init,eta_init,N_real,s_steps,rho,gainLength):    
+            thet_init,eta_init,N_real,s_steps,rho,gainLength,engine='slice',nworkers=None,z_chunk=None,\
+            record_z=None,record_slices=None,dtype='float64',sink=None,\
+            checkpoint_dir=None,checkpoint_every=None,resume=None,run_id=None,\
+            taper=None,taper_phase=None,taper_start=0.0,stop_after=None,stop_drop=None,stop_arm=0.5,\
+            slip_every=1,slippage='step',integrator='leapfrog',energy_balance=False,step_error=False,**kwargs):
+    '''
+    1D FEL process, evolving the particles and the field along the undulator
+    iopt='seeded' runs the steady state of the single bucket loaded for it on the 'zmajor' engine,
+    the bucket keeping its own field (no slippage)
+    Nruns>1 runs the ensemble on the 'zmajor' engine, with thet_init and eta_init of shape (Nruns, s_steps, npart)
+    engine              # 'slice' goes over the slices one by one and evolves each along z,
+                        # 'zmajor' goes along z and advances all slices at once with the same leap-frog,
+                        # 'numba' runs the fused compiled leap-frog, or 'zmajor' if numba is not installed,
+                        # 'wavefront' splits the slices in blocks over nworkers processes which pass
+                        # the field rows downstream every z_chunk steps
+    record_z            # z stations (0..z_steps) where theta/eta snapshots are kept, default all
+    record_slices       # slices whose snapshots are kept: None for the last slice, 'all', a stride or indices
+    thet_output and eta are the history of the last recorded slice at the recorded stations
+    dtype               # 'float64' or 'float32' for the particles, the field grid and the bunching;
+                        # in single precision theta is wrapped modulo 2 pi at every step
+    sink                # None, or an output_sink the field grid and the bunching are written into while
+                        # they are produced ('slice' by rows, 'zmajor' by columns, other engines at the end);
+                        # Er, Ei and bunching are then returned as its datasets
+    checkpoint_dir      # None, or a directory to write the state of the run to every checkpoint_every z steps
+                        # (default z_steps//10); runs on the 'zmajor' engine
+    resume              # None, or the checkpoint state to continue from, on the 'zmajor' engine
+    run_id              # id of the run in checkpoint_dir (checkpoint.save_inputs), written into every checkpoint
+    taper               # None to follow unduK, or 'resonant' to compute unduK along the undulator from
+                        # taper_start [m] on, keeping the resonant phase taper_phase [rad]; runs on the
+                        # 'zmajor' engine and returns the undulator parameter used as taper_unduK
+    stop_after          # None, or stop the run this many meters past the power maximum (on the 'zmajor' engine)
+    stop_drop           # None, or stop the run once the power has dropped by this fraction from its maximum
+    stop_arm            # the stop criteria only apply once the mean energy loss exceeds stop_arm*rho (entrance rho);
+                        # the histories then end at the stop step, recorded as z_stop [m]
+    slip_every          # z steps per slice (dels=slip_every*delt), other than 1 on the 'zmajor' engine
+    slippage            # 'step' to slip the field by a slice every slip_every steps, 'interp' to slip it
+                        # by 1/slip_every of a slice every step with linear interpolation between slices
+    integrator          # 'leapfrog', or 'yoshida4' on the 'zmajor' engine
+    energy_balance      # True to return the field energy gain and beam energy loss of every step as
+                        # field_gain and beam_loss, on the 'zmajor' engine
+    step_error          # True to return the power of the step doubled solution as fine_power, on the 'zmajor' engine
+    '''
 
     s = np.arange(1,s_steps+1)*dels*coopLength*1.0e6        # longitundinal steps along beam in micron ? meter           
     z = np.arange(1,z_steps+1)*delt*gainLength              # longitundinal steps along undulator in meter
@@ -168,46 +382,503 @@ def FEL_process(Nruns,npart,z_steps,energy,eSpread,\
     bunch_steps=np.round(bunchLength/delt/coopLength)       # rms (Gaussian) or half width (flattop) bunch length in s_step
     shape=N_real/np.max(N_real)
 
+    if engine not in ('slice','numba','wavefront','zmajor'):
+        raise ValueError('unknown engine '+str(engine))
+    if engine=='numba' and fel_numba.numba is None:
+        warnings.warn("numba is not installed, using engine='zmajor'")
+        engine='zmajor'
+
+    if iopt not in ('sase','seeded'):
+        raise ValueError('unknown iopt '+str(iopt))
+    slip_state=None
+    if iopt=='seeded':
+        if slip_every<1:
+            raise ValueError("slip_every must be at least 1")
+        slip_state={'every':slip_every,'mode':'none'}                       # no slippage, the field steps by delt
+    elif slip_every!=1 or slippage!='step':
+        if slippage not in ('step','interp'):
+            raise ValueError('unknown slippage '+str(slippage))
+        if slip_every<1 or (slippage=='step' and slip_every!=int(slip_every)):
+            raise ValueError("slip_every must be at least 1, and an integer with slippage='step'")
+        slip_state={'every':slip_every,'mode':slippage}
+
+    if Nruns>1 or checkpoint_dir is not None or resume is not None or taper is not None\
+       or stop_after is not None or stop_drop is not None or slip_state is not None\
+       or integrator!='leapfrog' or energy_balance or step_error or iopt=='seeded':
+        engine='zmajor'
+    if integrator not in ('leapfrog','yoshida4'):
+        raise ValueError('unknown integrator '+str(integrator))
+    if checkpoint_dir is not None and checkpoint_every is None:
+        checkpoint_every=max(1,z_steps//10)
+
+    dtype=np.dtype(dtype)
+    ctype=np.result_type(dtype,np.complex64)
+    wrap=dtype!=np.float64                                  # keep theta bounded when the mantissa is short
+    thet_init,eta_init,shape=thet_init.astype(dtype,copy=False),eta_init.astype(dtype,copy=False),shape.astype(dtype)
+    ku,delt,dels=dtype.type(ku),dtype.type(delt),dtype.type(dels)
+    deta,Kai,kappa=deta.astype(dtype),Kai.astype(dtype),(kappa_1*density).astype(dtype)
+
+    taper_state=None
+    if taper=='resonant':
+        if taper_phase is None:
+            raise ValueError("taper='resonant' needs taper_phase")
+        taper_state={'phase':taper_phase,'start':int(np.ceil(taper_start/(delt*gainLength))),\
+                     'unduK':np.array(unduK,dtype=np.float64),'gamma0':gamma0,'density':density}
+    elif taper is not None:
+        raise ValueError('unknown taper '+str(taper))
+
+    stop_state=None
+    if stop_after is not None or stop_drop is not None:
+        stop_state={'after':None if stop_after is None else int(np.ceil(stop_after/(delt*gainLength))),\
+                    'drop':stop_drop,'arm':stop_arm*np.ravel(rho)[0],'step':None}
+
+    balance={} if energy_balance else None
+    fine={} if step_error else None
+
+    record_z,record_slices=record_policy(record_z,record_slices,s_steps,z_steps)
+    engine_args=(thet_init,eta_init,shape,E02,npart,z_steps,ku,delt,dels,deta,kappa,Kai,record_z,record_slices,wrap)
+    if iopt=='sase' and engine=='numba':
+        Er,Ei,bunching,thet_record,eta_record,etaavg=fel_numba.FEL_process_numba(*engine_args)
+        Er,Ei,bunching=store_grid(sink,Er,Ei,bunching)
+    elif iopt=='sase' and engine=='wavefront':
+        Er,Ei,bunching,thet_record,eta_record,etaavg=wavefront.FEL_process_wavefront(*engine_args,\
+                                                                                    nworkers=nworkers,z_chunk=z_chunk)
+        Er,Ei,bunching=store_grid(sink,Er,Ei,bunching)
+    elif engine=='zmajor':
+        Er,Ei,bunching,thet_record,eta_record,etaavg=FEL_process_zmajor(*engine_args,sink=sink,\
+            checkpoint_dir=checkpoint_dir,checkpoint_every=checkpoint_every,resume=resume,run_id=run_id,taper=taper_state,stop=stop_state,slip=slip_state,\
+            integrator=integrator,balance=balance,fine=fine)
     # sase mode is chosen, go over all slices of the bunch starting from the tail k=1
-    if iopt=='sase': 
+    elif iopt=='sase': 
         # initialization of variables during the 1D FEL process
-        Er=np.zeros((s_steps+1,z_steps+1))
-        Ei=np.zeros((s_steps+1,z_steps+1))
-        eta=np.zeros((npart,z_steps+1))
-        thet_output=np.zeros((npart,z_steps+1))
-        thethalf=np.zeros((npart,z_steps+1))
-        thet_out=np.zeros((s_steps,1))
-        bunching=np.zeros((s_steps,z_steps),dtype=complex)
+        grid=sink if sink is not None else output_sink.memory_sink(grid_shapes(s_steps,z_steps,(),dtype))
+        thet_record=np.zeros((record_slices.shape[0],record_z.shape[0],npart),dtype=dtype)
+        eta_record=np.zeros((record_slices.shape[0],record_z.shape[0],npart),dtype=dtype)
+        etaavg=np.zeros(z_steps,dtype=dtype)
+        z_slot=record_slots(record_z,z_steps+1)
+        slice_slot=record_slots(record_slices,s_steps)
+        Er_next=np.zeros(z_steps+1,dtype=dtype)                                 # field row leaving the previous slice
+        Ei_next=np.zeros(z_steps+1,dtype=dtype)
         for k in range(s_steps):
-            Er[k,0] = np.sqrt(E02)                                              # input seed signal
-            Ei[k,0] = 0.0
+            Er_row,Ei_row=Er_next,Ei_next                                       # field row seen by slice k
+            Er_row[0] = np.sqrt(E02)                                            # input seed signal
+            Ei_row[0] = 0.0
+            Er_next=np.zeros(z_steps+1,dtype=dtype)
+            Ei_next=np.zeros(z_steps+1,dtype=dtype)
+            bunching_row=np.zeros(z_steps,dtype=ctype)
             thet0=thet_init[k,:]
             eta0=eta_init[k,:]
-            eta[:,0] = eta0.T
-            thet_output[:,0]=thet0.T                                                   # eta at j=1
-            thethalf[:,0] = thet0.T-2*ku*eta[:,0]*delt/2                             # half back
-            thet_out[k,0]=np.mean(thet0.T)
+            eta=eta0.copy()                                                     # rolling buffers, only the current
+            thethalf = thet0-2*ku*eta*delt/2                                    # and next step are kept; half back
+            r=slice_slot[k]
+            if r>=0 and z_slot[0]>=0:
+                thet_record[r,z_slot[0]]=thet0
+                eta_record[r,z_slot[0]]=eta0
             for j in range(z_steps):                                            # evolve e and eta in s and t by leap-frog
-                thet = thethalf[:,j]+2*ku*(eta[:,j]+deta[j])*delt/2
+                thet = thethalf+2*ku*(eta+deta[j])*delt/2
                 sumsin = np.sum(np.sin(thet))
                 sumcos = np.sum(np.cos(thet))
                 sinavg = shape[k]*sumsin/npart
                 cosavg = shape[k]*sumcos/npart
-                Erhalf = Er[k,j]+kappa_1[j]*density * cosavg*dels/2   #minus sign 
-                Eihalf = Ei[k,j]-kappa_1[j]*density * sinavg*dels/2               
-                thethalf[:,j+1] = thethalf[:,j]+2*ku*(eta[:,j]+deta[j])*delt
-                eta[:,j+1] = eta[:,j]-2*Kai[j]*Erhalf*np.cos(thethalf[:,j+1])*delt\
-                             +2*Kai[j]*Eihalf*np.sin(thethalf[:,j+1])*delt#-Eloss*delt  #Eloss*delt to simulate the taper
-                thet_output[:,j+1]=thet
-                sumsin = np.sum(np.sin(thethalf[:,j+1]))
-                sumcos = np.sum(np.cos(thethalf[:,j+1]))
+                Erhalf = Er_row[j]+kappa[j] * cosavg*dels/2   #minus sign 
+                Eihalf = Ei_row[j]-kappa[j] * sinavg*dels/2               
+                thethalf_next = thethalf+2*ku*(eta+deta[j])*delt
+                if wrap:
+                    thethalf_next = np.mod(thethalf_next,2*np.pi)
+                eta_next = eta-2*Kai[j]*Erhalf*np.cos(thethalf_next)*delt\
+                           +2*Kai[j]*Eihalf*np.sin(thethalf_next)*delt#-Eloss*delt  #Eloss*delt to simulate the taper
+                thethalf,eta = thethalf_next,eta_next
+                if r>=0 and z_slot[j+1]>=0:
+                    thet_record[r,z_slot[j+1]]=thet
+                    eta_record[r,z_slot[j+1]]=eta
+                sumsin = np.sum(np.sin(thethalf))
+                sumcos = np.sum(np.cos(thethalf))
                 sinavg = shape[k]*sumsin/npart
                 cosavg = shape[k]*sumcos/npart
-                Er[k+1,j+1] = Er[k,j]+kappa_1[j]*density *cosavg*dels                               # apply slippage condition
-                Ei[k+1,j+1] = Ei[k,j]-kappa_1[j]*density *sinavg*dels
-                bunching[k,j]=np.mean(np.real(np.exp(-1j*thet)))\
+                Er_next[j+1] = Er_row[j]+kappa[j] *cosavg*dels                   # apply slippage condition
+                Ei_next[j+1] = Ei_row[j]-kappa[j] *sinavg*dels
+                bunching_row[j]=np.mean(np.real(np.exp(-1j*thet)))\
                               +np.mean(np.imag(np.exp(-1j*thet)))*1j            #bunching factor calculation
-    return {'Er':Er,'Ei':Ei,'thet_output':thet_output,'eta':eta,'s':s,'z':z,'bunching':bunching,'bunchLength':bunchLength}
+                if k==s_steps-1:
+                    etaavg[j] = np.sum(eta)/npart                               # average electron energy of the last slice
+            output_sink.sink_write(grid,'Er',-2,k,Er_row)                       # slice k is done with its rows
+            output_sink.sink_write(grid,'Ei',-2,k,Ei_row)
+            output_sink.sink_write(grid,'bunching',-2,k,bunching_row)
+        output_sink.sink_write(grid,'Er',-2,s_steps,Er_next)
+        output_sink.sink_write(grid,'Ei',-2,s_steps,Ei_next)
+        output_sink.sink_flush(grid)
+        Er,Ei,bunching=grid['datasets']['Er'],grid['datasets']['Ei'],grid['datasets']['bunching']
+    z_stop=None
+    if stop_state is not None and stop_state['step'] is not None:
+        #truncate the histories at the stop step
+        n=stop_state['step']
+        z_stop=z[n-1]
+        z=z[:n]
+        if isinstance(Er,np.ndarray):
+            Er,Ei,bunching=Er[...,:n+1],Ei[...,:n+1],bunching[...,:n]
+        kept=record_z<=n
+        thet_record,eta_record,record_z=thet_record[...,kept,:],eta_record[...,kept,:],record_z[kept]
+        etaavg=etaavg[...,:n]
+        if balance is not None:
+            balance={name:value[...,:n] for name,value in balance.items()}
+        if fine is not None:
+            fine['power']=fine['power'][...,:n+1]
+    thet_output=np.swapaxes(thet_record[...,-1,:,:],-1,-2) if record_slices.shape[0] else None
+    eta=np.swapaxes(eta_record[...,-1,:,:],-1,-2) if record_slices.shape[0] else None
+    return {'Er':Er,'Ei':Ei,'thet_output':thet_output,'eta':eta,'s':s,'z':z,'bunching':bunching,'bunchLength':bunchLength,\
+            'thet_record':thet_record,'eta_record':eta_record,'recorded_z':record_z,'recorded_slices':record_slices,'etaavg':etaavg,\
+            'taper_unduK':unduK if taper_state is None else taper_state['unduK'],'z_stop':z_stop,\
+            'field_gain':None if balance is None else balance['field_gain'],\
+            'beam_loss':None if balance is None else balance['beam_loss'],\
+            'fine_power':None if fine is None else fine['power']}
+
+def FEL_process_zmajor(thet_init,eta_init,shape,E02,npart,z_steps,ku,delt,dels,deta,kappa,Kai,record_z,record_slices,wrap=False,sink=None,\
+                       checkpoint_dir=None,checkpoint_every=None,resume=None,taper=None,stop=None,slip=None,\
+                       integrator='leapfrog',balance=None,fine=None,run_id=None):
+    '''
+    z-major leap-frog: Er[k+1,j+1] only depends on row j, so every z step
+    advances the whole (s_steps, npart) particle block at once
+    inputs:
+    thet_init           # all buckets macro particles position, shape (..., s_steps, npart)
+    eta_init            # all buckets macro particles relative energy, shape (..., s_steps, npart)
+    shape               # relative current of each slice
+    kappa               # kappa_1*density along the undulator
+    record_z            # z stations (0..z_steps) where the phase space is recorded
+    record_slices       # slices whose phase space is recorded
+    wrap                # wrap theta modulo 2 pi after every step
+    sink                # optional output_sink the field and bunching columns are written into
+    checkpoint_dir      # optional directory to write the running state to every checkpoint_every steps,
+                        # the columns done so far stay in the sink, which is then needed
+    run_id              # id of the run, written into its checkpoints
+    resume              # optional checkpoint state (checkpoint.read_checkpoint) to continue from, with the
+                        # sink reopened on the columns written before it
+    taper               # optional resonant phase taper (see resonant_taper), deta, kappa, Kai and
+                        # taper['unduK'] are then overwritten in place from its start step on
+    stop                # optional early stop (see stop_reached), stop['step'] is set to the number of
+                        # steps done when it fires; the outputs keep their full z size
+    slip                # optional dict with the slice spacing in steps 'every' (dels=every*delt) and the
+                        # slippage 'mode' (see slip_fraction, 'none' for the steady state); row k+1 of a column is then always the field
+                        # leaving slice k, and the field seen by the slices is interpolated from them
+    integrator          # 'leapfrog' (leapfrog_step) or 'yoshida4' (yoshida_step)
+    balance             # optional dict, filled with the field energy gain 'field_gain' and the beam energy
+                        # loss 'beam_loss' of every step (see energy_change), shape (..., z_steps)
+    fine                # optional dict, filled with the state of the step doubled solution (see fine_step)
+                        # and its field column power 'power' summed over the rows, shape (..., z_steps+1)
+    outputs:
+    Er, Ei              # field grid, shape (..., s_steps+1, z_steps+1)
+    bunching            # bunching factor, shape (..., s_steps, z_steps)
+    thet_record         # recorded phases, shape (..., len(record_slices), len(record_z), npart)
+    eta_record          # recorded relative energies, same shape as thet_record
+    etaavg              # average energy of the last slice after every step, shape (..., z_steps)
+    any leading axes of the particle arrays (e.g. runs) are carried through, and the arrays
+    keep the dtype of thet_init
+    '''
+    if (checkpoint_dir is not None or resume is not None) and sink is None:
+        raise ValueError('checkpoints need an output sink holding the field grid')
+    lead=thet_init.shape[:-2]
+    s_steps=thet_init.shape[-2]
+    dtype=thet_init.dtype
+    grid=sink if sink is not None else output_sink.memory_sink(grid_shapes(s_steps,z_steps,lead,dtype))
+    thet_record=np.zeros(lead+(record_slices.shape[0],record_z.shape[0],npart),dtype=dtype)
+    eta_record=np.zeros(lead+(record_slices.shape[0],record_z.shape[0],npart),dtype=dtype)
+    etaavg=np.zeros(lead+(z_steps,),dtype=dtype)
+    z_slot=record_slots(record_z,z_steps+1)
+    Er_col=np.zeros(lead+(s_steps+1,),dtype=dtype)                         # field column of the current z step
+    Ei_col=np.zeros(lead+(s_steps+1,),dtype=dtype)
+    step=leapfrog_step if integrator=='leapfrog' else yoshida_step
+    if balance is not None:
+        balance['field_gain']=np.zeros(lead+(z_steps,))
+        balance['beam_loss']=np.zeros(lead+(z_steps,))
+    if fine is not None:
+        fine['power']=np.zeros(lead+(z_steps+1,))
+    if resume is None:
+        j_start=0
+        Er_col[...,:s_steps] = np.sqrt(E02)                                 # input seed signal
+        output_sink.sink_write(grid,'Er',-1,0,Er_col)
+        output_sink.sink_write(grid,'Ei',-1,0,Ei_col)
+        eta_s = eta_init.copy()
+        thethalf = thet_init-2*ku*eta_s*delt/2                             # half back
+        if integrator!='leapfrog':
+            thethalf = thet_init.copy()                                     # yoshida_step starts on the step
+        if z_slot[0]>=0:
+            thet_record[...,z_slot[0],:] = thet_init[...,record_slices,:]
+            eta_record[...,z_slot[0],:] = eta_init[...,record_slices,:]
+        if fine is not None:
+            fine.update(thethalf=thet_init-2*ku*eta_s*delt/4 if integrator=='leapfrog' else thet_init.copy(),\
+                        eta_s=eta_s.copy(),Er_col=Er_col.copy(),Ei_col=Ei_col.copy())
+            fine['power'][...,0]=np.sum(Er_col**2+Ei_col**2,axis=-1,dtype=np.float64)
+    else:
+        j_start=resume['step']
+        thethalf,eta_s=resume['thethalf'].copy(),resume['eta_s'].copy()
+        Er_col[...],Ei_col[...]=resume['Er_col'],resume['Ei_col']
+        thet_record[...],eta_record[...],etaavg[...]=resume['thet_record'],resume['eta_record'],resume['etaavg']
+        if taper is not None:
+            deta[...],kappa[...],Kai[...],taper['unduK'][...]=resume['deta'],resume['kappa'],resume['Kai'],resume['unduK']
+        if balance is not None:
+            balance['field_gain'][...],balance['beam_loss'][...]=resume['field_gain'],resume['beam_loss']
+        if fine is not None:
+            fine.update({name:resume['fine_'+name].copy() for name in ['thethalf','eta_s','Er_col','Ei_col']})
+            fine['power'][...]=resume['fine_power']
+        if stop is not None:
+            stop.update(eta0=float(resume['stop_eta0']),power_max=float(resume['stop_power_max']),\
+                        peak=int(resume['stop_peak']))
+    if stop is not None and resume is None:
+        stop.update(eta0=np.mean(shape*np.mean(eta_s,axis=-1))/np.mean(shape),power_max=0.0,peak=0)
+    bunching_j=None if j_start==0 else resume['bunching_j']
+    field_step=dels if slip is None else dels/slip['every']                 # field growth along its characteristic
+    for j in range(j_start,z_steps):
+        if fine is not None:
+            fine_step(fine,step,slip_fraction(slip,j),shape,npart,ku,delt,field_step,deta[j],kappa[j],Kai[j],wrap)
+            fine['power'][...,j+1]=np.sum(fine['Er_col']**2+fine['Ei_col']**2,axis=-1,dtype=np.float64)
+        Er_seen,Ei_seen=slipped_field(Er_col,Ei_col,slip_fraction(slip,j))
+        if taper is not None and j>=taper['start']:
+            deta[j],kappa[j],Kai[j]=resonant_taper(taper,j,deta,Kai,Er_seen,Ei_seen,bunching_j,shape,delt)
+        if balance is not None:
+            eta_before,Er_before,Ei_before=eta_s,Er_seen.copy(),Ei_seen.copy()   # the step overwrites the column
+        thet,thethalf,eta_s,Er_col[...,1:],Ei_col[...,1:],bunching_j=step(thethalf,eta_s,\
+            Er_seen,Ei_seen,shape,npart,ku,delt,field_step,deta[j],kappa[j],Kai[j],wrap)
+        if balance is not None:
+            balance['field_gain'][...,j],balance['beam_loss'][...,j]=energy_change(Er_before,Ei_before,\
+                Er_col[...,1:],Ei_col[...,1:],eta_before,eta_s,shape,kappa[j],Kai[j])
+        Er_col[...,0] = 0.0                                                 # the head row only carries the seed
+        output_sink.sink_write(grid,'Er',-1,j+1,Er_col)
+        output_sink.sink_write(grid,'Ei',-1,j+1,Ei_col)
+        output_sink.sink_write(grid,'bunching',-1,j,bunching_j)
+        if z_slot[j+1]>=0:
+            thet_record[...,z_slot[j+1],:] = thet[...,record_slices,:]
+            eta_record[...,z_slot[j+1],:] = eta_s[...,record_slices,:]
+        etaavg[...,j] = np.sum(eta_s[...,-1,:],axis=-1)/npart
+        if stop is not None and stop_reached(stop,j+1,Er_col,Ei_col,eta_s,shape):
+            stop['step']=j+1
+            break
+        if checkpoint_dir is not None and (j+1)%checkpoint_every==0 and j+1<z_steps:
+            output_sink.sink_flush(grid)
+            checkpoint.write_checkpoint(checkpoint_dir,j+1,run_id,{'thethalf':thethalf,'eta_s':eta_s,'Er_col':Er_col,'Ei_col':Ei_col,\
+                'bunching_j':bunching_j,'thet_record':thet_record,'eta_record':eta_record,'etaavg':etaavg,\
+                **({} if taper is None else {'deta':deta,'kappa':kappa,'Kai':Kai,'unduK':taper['unduK']}),\
+                **({} if balance is None else balance),\
+                **({} if fine is None else {'fine_'+name:value for name,value in fine.items()}),\
+                **({} if stop is None else {'stop_eta0':stop['eta0'],'stop_power_max':stop['power_max'],\
+                                            'stop_peak':stop['peak']})})
+    output_sink.sink_flush(grid)
+    return grid['datasets']['Er'],grid['datasets']['Ei'],grid['datasets']['bunching'],thet_record,eta_record,etaavg
+
+def grid_shapes(s_steps,z_steps,lead,dtype):
+    '''
+    shape and dtype of the field grid and the bunching, for the output sinks
+    '''
+    dtype=np.dtype(dtype)
+    ctype=np.result_type(dtype,np.complex64)
+    return {'Er':(lead+(s_steps+1,z_steps+1),dtype),'Ei':(lead+(s_steps+1,z_steps+1),dtype),\
+            'bunching':(lead+(s_steps,z_steps),ctype)}
+
+def store_grid(sink,Er,Ei,bunching):
+    '''
+    copy a field grid computed in memory into the sink, if any, and hand back its datasets
+    '''
+    if sink is None:
+        return Er,Ei,bunching
+    for name,value in (('Er',Er),('Ei',Ei),('bunching',bunching)):
+        output_sink.sink_store(sink,name,value)
+    return sink['datasets']['Er'],sink['datasets']['Ei'],sink['datasets']['bunching']
+
+def yoshida_step(thet,eta,Er,Ei,shape,npart,ku,delt,dels,deta_j,kappa_j,Kai_j,wrap=False):
+    '''
+    one 4th-order z step: Yoshida's composition of three symmetric steps drift(h/2) kick(h) drift(h/2)
+    with weights w1, w0, w1 (H. Yoshida, Phys. Lett. A 150, 262 (1990)); for fixed phases the field
+    grows linearly, so the kick advances the field and the energies exactly with the mid-kick field
+    inputs and outputs as leapfrog_step, except that the phases are carried at the step boundaries:
+    thet                # particle phases at the start of the step, shape (..., npart)
+    the returned thet and thethalf are both the phases at the end of the step
+    '''
+    w1=1/(2-2**(1/3))
+    w0=1-2*w1
+    for drift,kick in ((w1/2,w1),((w1+w0)/2,w0),((w0+w1)/2,w1)):
+        thet = thet+2*ku*(eta+deta_j)*drift*delt
+        if wrap:
+            thet = np.mod(thet,2*np.pi)
+        costh = np.cos(thet)
+        sinth = np.sin(thet)
+        cosavg = shape*np.sum(costh,axis=-1)/npart
+        sinavg = shape*np.sum(sinth,axis=-1)/npart
+        Erhalf = Er+kappa_j * cosavg*kick*dels/2
+        Eihalf = Ei-kappa_j * sinavg*kick*dels/2
+        eta = eta-2*Kai_j*Erhalf[...,np.newaxis]*costh*kick*delt\
+              +2*Kai_j*Eihalf[...,np.newaxis]*sinth*kick*delt
+        Er = Er+kappa_j *cosavg*kick*dels
+        Ei = Ei-kappa_j *sinavg*kick*dels
+    thet = thet+2*ku*(eta+deta_j)*w1/2*delt
+    if wrap:
+        thet = np.mod(thet,2*np.pi)
+    expthet = np.exp(-1j*thet)
+    bunching = np.mean(np.real(expthet),axis=-1)+np.mean(np.imag(expthet),axis=-1)*1j
+    return thet,thet,eta,Er,Ei,bunching
+
+def energy_change(Er_seen,Ei_seen,Er,Ei,eta_before,eta,shape,kappa_j,Kai_j):
+    '''
+    energy exchanged in one z step, in units of the beam power of a full current slice: the field
+    energy Kai/kappa*|E|**2 gained by the slices along their characteristics and the energy lost by
+    the particles weighted by the current; the equations of motion conserve their sum
+    outputs:
+    field_gain, beam_loss   # summed over the slices, shape (...)
+    '''
+    Kai_field=Kai_j[...,0] if np.ndim(Kai_j) else Kai_j                    # a batch Kai has the particle axis
+    field_gain=np.sum((Er.astype(np.float64)**2+Ei.astype(np.float64)**2\
+                       -Er_seen.astype(np.float64)**2-Ei_seen.astype(np.float64)**2)*(Kai_field/kappa_j),axis=-1)
+    beam_loss=np.sum(shape*np.mean(eta_before-eta,axis=-1,dtype=np.float64),axis=-1)
+    return field_gain,beam_loss
+
+def fine_step(fine,step,fraction,shape,npart,ku,delt,dels,deta_j,kappa_j,Kai_j,wrap=False):
+    '''
+    advance the step doubled solution of the step error estimate by one z step, done as two
+    steps of half the length: the slices see the slipped field for the first and their own
+    field for the second, so slippage and coefficients follow the run itself
+    inputs:
+    fine                # dict with the solution's 'thethalf', 'eta_s', 'Er_col' and 'Ei_col', updated in place
+    step                # leapfrog_step or yoshida_step
+    fraction            # slippage before the step, as returned by slip_fraction
+    the other inputs as for step, for the full z step
+    '''
+    Er,Ei=slipped_field(fine['Er_col'],fine['Ei_col'],fraction)
+    thethalf,eta=fine['thethalf'],fine['eta_s']
+    for half in range(2):
+        thet,thethalf,eta,Er,Ei,bunching=step(thethalf,eta,Er,Ei,shape,npart,ku,delt/2,dels/2,deta_j,kappa_j,Kai_j,wrap)
+    fine['thethalf'],fine['eta_s']=thethalf,eta
+    fine['Er_col'][...,1:],fine['Ei_col'][...,1:]=Er,Ei
+    fine['Er_col'][...,0]=0.0
+
+def slip_fraction(slip,j):
+    '''
+    fraction of a slice the field slips over before z step j: one slice every step without slip,
+    with slip mode 'step' one slice every slip['every'] steps and none in between, with 'interp'
+    1/slip['every'] of a slice every step, with 'none' never; the first step always sees the seed
+    column as it is
+    '''
+    if slip is None or j==0:
+        return 1.0
+    if slip['mode']=='none':
+        return 0.0
+    if slip['mode']=='interp':
+        return 1.0/slip['every']
+    return 1.0 if j%slip['every']==0 else 0.0
+
+def slipped_field(Er,Ei,fraction):
+    '''
+    field seen by the slices from a column of shape (..., s_steps+1) whose row k+1 left slice k:
+    the row of the slice behind for a whole slice of slippage, its own row for none, and the
+    linear interpolation between them in between
+    '''
+    if fraction==1.0:
+        return Er[...,:-1],Ei[...,:-1]
+    if fraction==0.0:
+        return Er[...,1:],Ei[...,1:]
+    return (1-fraction)*Er[...,1:]+fraction*Er[...,:-1],(1-fraction)*Ei[...,1:]+fraction*Ei[...,:-1]
+
+def stop_reached(stop,n,Er,Ei,eta,shape):
+    '''
+    early stop test after n z steps: the power leaving the slices is tracked together with
+    its maximum, and once the current weighted mean energy loss exceeds stop['arm'] the
+    run stops stop['after'] steps past the maximum, or when the power has dropped by the
+    fraction stop['drop'] from it
+    '''
+    power=np.sum(Er[...,1:]**2+Ei[...,1:]**2,dtype=np.float64)
+    if power>stop['power_max']:
+        stop['power_max'],stop['peak']=power,n
+    loss=stop['eta0']-np.mean(shape*np.mean(eta,axis=-1))/np.mean(shape)
+    if loss<stop['arm']:
+        return False
+    if stop['after'] is not None and n-stop['peak']>=stop['after']:
+        return True
+    return stop['drop'] is not None and power<=(1-stop['drop'])*stop['power_max']
+
+def resonant_taper(taper,j,deta,Kai,Er,Ei,bunching,shape,delt):
+    '''
+    undulator parameter of z step j keeping the resonant phase: the resonant energy
+    eta_r=-deta loses 2*Kai*|E|*sin(phase) per unit length, |E| being the field of the
+    slices weighted by their current and bunching (all slices and runs share one undulator)
+    inputs:
+    taper               # dict with the resonant phase 'phase', the first tapered step 'start',
+                        # the undulator parameter 'unduK' (filled in place), 'gamma0' and 'density'
+    Er, Ei              # field seen by the slices at step j, shape (..., s_steps)
+    bunching            # bunching factor of the slices at the previous step, None before the first
+    outputs:
+    deta_j, kappa_j, Kai_j  # detune and couplings of step j
+    '''
+    K=taper['unduK']
+    if j==taper['start'] or bunching is None:
+        deta_j=float(deta[j])                                               # taper starts from the given unduK
+    else:
+        weight=shape*np.abs(bunching)
+        if np.sum(weight)==0:
+            weight=np.broadcast_to(shape,weight.shape)
+        field=np.sum(weight*np.abs(Er+1j*Ei))/np.sum(weight)
+        deta_j=float(deta[j-1])+2*float(Kai[j-1])*field*np.sin(taper['phase'])*delt   # eta_r=-deta goes down
+    K[j]=np.sqrt(max(2*((1+0.5*K[0]**2)/(1+deta_j)**2-1),0.0))
+    unduJJ,kappa_1,Kai_j=undulator_coupling(K[j],taper['gamma0'])
+    return deta_j,kappa_1*taper['density'],Kai_j
+
+def record_policy(record_z,record_slices,s_steps,z_steps):
+    '''
+    phase space recording policy
+    inputs:
+    record_z            # None for every z station, or station indices 0..z_steps (0 is the undulator entrance)
+    record_slices       # None for the last slice, 'all', an int stride, or slice indices
+    outputs:
+    record_z, record_slices  # sorted index arrays
+    '''
+    if record_z is None:
+        record_z=np.arange(z_steps+1)
+    if record_slices is None:
+        record_slices=[s_steps-1]
+    elif isinstance(record_slices,str) and record_slices=='all':
+        record_slices=np.arange(s_steps)
+    elif np.isscalar(record_slices):
+        record_slices=np.arange(0,s_steps,int(record_slices))
+    record_z=np.unique(np.arange(z_steps+1)[np.asarray(record_z,dtype=int)])
+    record_slices=np.unique(np.arange(s_steps)[np.asarray(record_slices,dtype=int)])
+    return record_z,record_slices
+
+def record_slots(index,n):
+    '''
+    position of every step or slice in the record, -1 where it is not recorded
+    '''
+    slots=-np.ones(n,dtype=int)
+    slots[index]=np.arange(index.shape[0])
+    return slots
+
+def leapfrog_step(thethalf,eta,Er,Ei,shape,npart,ku,delt,dels,deta_j,kappa_j,Kai_j,wrap=False):
+    '''
+    one leap-frog z step for any number of slices, particles along the last axis
+    inputs:
+    thethalf            # particle phases at the half step, shape (..., npart)
+    eta                 # particle relative energies, shape (..., npart)
+    Er, Ei              # field seen by each slice, shape (...)
+    shape               # relative current of each slice, shape (...)
+    deta_j, kappa_j, Kai_j  # taper detune, kappa_1*density and Kai at this step
+    wrap                # wrap the new theta modulo 2 pi
+    outputs:
+    thet                # particle phases at the full step
+    thethalf, eta       # particles advanced by one step
+    Er, Ei              # field handed to the next slice
+    bunching            # bunching factor of each slice
+    '''
+    thet = thethalf+2*ku*(eta+deta_j)*delt/2
+    sinavg = shape*np.sum(np.sin(thet),axis=-1)/npart
+    cosavg = shape*np.sum(np.cos(thet),axis=-1)/npart
+    Erhalf = Er+kappa_j * cosavg*dels/2
+    Eihalf = Ei-kappa_j * sinavg*dels/2
+    thethalf = thethalf+2*ku*(eta+deta_j)*delt
+    if wrap:
+        thethalf = np.mod(thethalf,2*np.pi)
+    eta = eta-2*Kai_j*Erhalf[...,np.newaxis]*np.cos(thethalf)*delt\
+          +2*Kai_j*Eihalf[...,np.newaxis]*np.sin(thethalf)*delt
+    sinavg = shape*np.sum(np.sin(thethalf),axis=-1)/npart
+    cosavg = shape*np.sum(np.cos(thethalf),axis=-1)/npart
+    Er = Er+kappa_j *cosavg*dels                                            # apply slippage condition
+    Ei = Ei-kappa_j *sinavg*dels
+    expthet = np.exp(-1j*thet)
+    bunching = np.mean(np.real(expthet),axis=-1)+np.mean(np.imag(expthet),axis=-1)*1j
+    return thet,thethalf,eta,Er,Ei,bunching
 
 def final_calc(Nruns,npart,z_steps,energy,eSpread,\
             emitN,currentMax,beta,unduPeriod,unduK,unduL,radWavelength,\
@@ -216,31 +887,109 @@ def final_calc(Nruns,npart,z_steps,energy,eSpread,\
             Kai,ku,resWavelength,Pbeam,coopLength,z0,\
             delt,dels,E02,gbar,delg,Ns,deta,\
             thet_init,eta_init,N_real,s_steps,\
-            Er,Ei,thet_output,eta,s,z,rho,gainLength,bunching,bunchLength):
- 
-    #converting a and eta to field, power and etaavg
-    power_s=np.zeros((z_steps,s_steps))
-    power_z=np.zeros(z_steps)
-    etaavg=np.zeros(z_steps)
-    for j in range(z_steps):
-        for k in range(s_steps):
-            power_s[j,k] = (Er[k+1,j]**2+Ei[k+1,j]**2)*Kai[j]/(density*kappa_1[j])*Pbeam
-        power_z[j] = np.sum(Er[:,j]**2+Ei[:,j]**2)*Kai[j]/(density*kappa_1[j])*Pbeam/s_steps
-        etaavg[j] = np.sum(eta[:,j+1])/npart                                # average electron energy at every z position
-        thet_out=0                                                          # don't output phase space
-        eta_out=0
+            Er,Ei,thet_output,eta,s,z,rho,gainLength,bunching,bunchLength,\
+            thet_record,eta_record,recorded_z,recorded_slices,etaavg,\
+            power_s_out=None,power_z_out=None,field_s_out=None,\
+            spectrum_z=None,spectrum_nfft=None,spectrum_window=None,fft_workers=-1,sink=None,taper_unduK=None,z_stop=None,\
+            field_gain=None,beam_loss=None,fine_power=None,integrator='leapfrog',**kwargs):
+    '''
+    converting the field grid to power, field and spectrum, all as array expressions over
+    the grid (and any leading run axis)
+    power_s_out         # optional array of shape (..., z_steps, s_steps) to write power_s into
+    power_z_out         # optional array of shape (..., z_steps) to write power_z into
+    field_s_out         # optional complex array of shape (..., s_steps+1, z_steps+1) to write field_s into
+    spectrum_z          # z stations (0..z_steps) where the spectrum along the bunch is taken, default the exit
+    spectrum_nfft       # FFT length, s_steps or more to zero-pad, default s_steps
+    spectrum_window     # None or a window name of scipy.signal.get_window applied along s
+    fft_workers         # threads for scipy.fft, -1 for all cores
+    sink                # None, or the output_sink holding Er and Ei: the grid is then read a block of z
+                        # columns at a time and power_s and field_s are written into the sink's datasets
+    '''
+    #converting a and eta to field and power, z block by z block when the grid is in a sink
+    scale=Kai/(density*kappa_1)*Pbeam                                       # |E|^2 to power at every z step
+    step=np.maximum(np.arange(-1,z_steps),0)                                # z step of every grid column
+    field_scale=np.sqrt(Kai[step]/(density*kappa_1[step]*Pbeam))
+    spectrum_z=spectrum_stations(spectrum_z,z_steps)
+    block=z_steps+1 if sink is None else sink['block']
+    if sink is not None:
+        power_s,field_s=sink['datasets']['power_s'],sink['datasets']['field_s']
+    power_z=[]
+    field_z=[]
+    for j0 in range(0,z_steps+1,block):
+        j1=min(j0+block,z_steps+1)
+        jp=min(j1,z_steps)                                                  # power_s covers the columns before the exit
+        Er_b=np.asarray(Er[...,:,j0:j1])
+        Ei_b=np.asarray(Ei[...,:,j0:j1])
+        power_b=np.square(np.swapaxes(Er_b[...,1:,:jp-j0],-1,-2),out=out_block(power_s_out,sink,(Ellipsis,slice(j0,jp),slice(None))))
+        power_b+=np.square(np.swapaxes(Ei_b[...,1:,:jp-j0],-1,-2))
+        power_z.append(np.add(np.sum(power_b,axis=-1),Er_b[...,0,:jp-j0]**2+Ei_b[...,0,:jp-j0]**2,\
+                              out=out_block(power_z_out,sink,(Ellipsis,slice(j0,jp)))))
+        power_z[-1]*=scale[j0:jp]
+        power_z[-1]/=s_steps
+        power_b*=Kai[j0:jp,np.newaxis]
+        power_b/=density*kappa_1[j0:jp,np.newaxis]
+        power_b*=Pbeam
+        field_b=np.multiply(Ei_b,1j,out=out_block(field_s_out,sink,(Ellipsis,slice(j0,j1))))
+        field_b+=Er_b
+        field_b*=field_scale[j0:j1]
+        here=np.nonzero((spectrum_z>=j0)&(spectrum_z<j1))[0]                # spectrum stations in this block
+        field_z.append((here,np.swapaxes(field_b[...,1:,spectrum_z[here]-j0],-1,-2)))
+        if j0<=z_steps<j1:
+            field = (Er_b[...,:,z_steps-j0]+Ei_b[...,:,z_steps-j0]*1j)*np.sqrt(scale[z_steps-1])
+        if sink is not None:
+            power_s[...,j0:jp,:]=power_b
+            field_s[...,:,j0:j1]=field_b
+        else:
+            power_s,field_s=power_b,field_b
+    power_z=power_z[0] if len(power_z)==1 else np.concatenate(power_z,axis=-1)
+    if power_z_out is not None:
+        power_z_out[...]=power_z
+        power_z=power_z_out
+    thet_out=0                                                              # don't output phase space
+    eta_out=0
     detune = 2*np.pi/(dels*s_steps)*np.arange(-s_steps/2,s_steps/2+1)
-    field = (Er[:,z_steps]+Ei[:,z_steps]*1j)*np.sqrt(Kai[z_steps-1]/(density*kappa_1[z_steps-1])*Pbeam)
-    field_s = (Er[:,:]+Ei[:,:]*1j)*np.sqrt(np.concatenate((np.array([Kai[0]]),Kai))[np.newaxis,:]/(density*np.concatenate((np.array([kappa_1[0]]),kappa_1))[np.newaxis,:]*Pbeam))
-    pfft = np.fft.fft(field_s[:,1:],axis=1)
-    spectrum = np.fft.fftshift(np.absolute(pfft)**2)
+    if spectrum_nfft is None:
+        spectrum_nfft=s_steps
+    order=np.argsort(np.concatenate([here for here,field_b in field_z]))
+    field_z=np.concatenate([field_b for here,field_b in field_z],axis=-2)[...,order,:]   # field along the bunch at the stations
+    if spectrum_window is not None:
+        field_z=field_z*scipy.signal.get_window(spectrum_window,s_steps)
+    pfft = scipy.fft.fft(field_z,n=spectrum_nfft,axis=-1,workers=fft_workers)
+    spectrum = scipy.fft.fftshift(np.absolute(pfft)**2,axes=-1)
     omega=hbar * 2.0 * np.pi / (resWavelength/c)
-    df=hbar * 2.0 * np.pi*1/(bunchLength/c)
-    freq = np.linspace(omega - s_steps/2 * df, omega + s_steps/2 * df,s_steps)
-    history={'z':z,'power_z':power_z,'s':s,'power_s':power_s,'field':field,'field_s':field_s,'thet_output':thet_output,'eta':eta,'rho':rho,'detune':detune,'iopt':iopt,'spectrum':spectrum,'freq':freq}        
+    freq = omega+hbar * 2.0 * np.pi*scipy.fft.fftshift(scipy.fft.fftfreq(spectrum_nfft,d=dels*coopLength/c))
+    energy_balance=None
+    if field_gain is not None:
+        lost=np.cumsum(beam_loss,axis=-1)
+        energy_balance=(np.cumsum(field_gain,axis=-1)-lost)/np.maximum(np.max(np.abs(lost),axis=-1,keepdims=True),1e-300)
+    power_z_error=None
+    if fine_power is not None:
+        #step doubling: the error of the full steps is 2**p/(2**p-1) times their difference to the half steps
+        order=4 if integrator=='yoshida4' else 2
+        power_z_error=np.abs(power_z-fine_power[...,:z_steps]*scale[:z_steps]/s_steps)*2**order/(2**order-1)
+    history={'z':z,'power_z':power_z,'s':s,'power_s':power_s,'field':field,'field_s':field_s,'thet_output':thet_output,'eta':eta,'rho':rho,'detune':detune,'iopt':iopt,'spectrum':spectrum,'freq':freq,\
+             'spectrum_z':spectrum_z,'etaavg':etaavg,'thet_record':thet_record,'eta_record':eta_record,'recorded_z':recorded_z,'recorded_slices':recorded_slices,\
+             'taper_unduK':taper_unduK,'z_stop':z_stop,'energy_balance':energy_balance,\
+             'power_z_error':power_z_error}
 
     return {'history':history,'thet_out':thet_out,'eta_out':eta_out}
 
+def out_block(out,sink,index):
+    '''
+    block of a preallocated output array to compute into, None when there is none or a sink takes the output
+    '''
+    if out is None or sink is not None:
+        return None
+    return out[index]
+
+def spectrum_stations(spectrum_z,z_steps):
+    '''
+    z stations (0..z_steps) where the spectrum is taken, default the undulator exit
+    '''
+    if spectrum_z is None:
+        spectrum_z=[z_steps]
+    return np.arange(z_steps+1)[np.atleast_1d(np.asarray(spectrum_z,dtype=int))]
+
 
 
 def plot_log_power_z(history):
@@ -266,7 +1015,8 @@ def plot_phase_space(history):
     eta=history['eta']
     iopt=history['iopt']
     rho=history['rho']
-    for j in range(z.shape[0]):
+    recorded_z=history['recorded_z']
+    for j in range(recorded_z.shape[0]):
         plt.figure()
         plt.plot(thet_output[:,j],eta[:,j],'.')
         plt.xlabel('theta')
@@ -277,7 +1027,7 @@ def plot_phase_space(history):
             pass
             #plt.axis([0,9,8400000,8500000])
             #plt.axis([0,9,-2.5,2.5])
-        plt.title('undulator distance (m) = '+str(z[j]))
+        plt.title('undulator distance (m) = '+str(recorded_z[j]*z[0]))
         #pause(.02)
 
 def plot_pspec(history):
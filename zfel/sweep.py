@@ -0,0 +1,119 @@
+import numpy as np
+from zfel import sase1d_input_part
+
+
+def run_sweep(inp_structs):
+    '''
+    parameter sweep advanced in one pass: the configurations are stacked along a batch
+    axis and go through the z-major leap-frog together, with the per-configuration
+    coefficients (ku, delt, dels, deta, kappa_1*density, Kai, E02, current shape)
+    broadcast against it; iopt='seeded' configurations are a batch of steady-state buckets
+    inputs:
+    inp_structs         # list of sase() input dicts with the same npart, s_steps, z_steps, iopt, dtype, slippage
+                        # options, integrator, energy_balance and step_error, Nruns=1, no taper, early stop, checkpoints or output_file; record_z and record_slices are taken from the first one
+    outputs:
+    outputs             # list with the sase() output tuple of every configuration, the same as
+                        # sase() with engine='zmajor' run one configuration after the other
+    '''
+    first=inp_structs[0]
+    for inp_struct in inp_structs:
+        sase1d_input_part.check_inputs(inp_struct)
+        for key in ['npart','s_steps','z_steps','iopt']:
+            if inp_struct[key]!=first[key]:
+                raise ValueError('all sweep configurations need the same '+key)
+        for key,default in [('dtype','float64'),('slip_every',1),('slippage','step'),('integrator','leapfrog'),\
+                            ('energy_balance',False),('step_error',False)]:
+            if inp_struct.get(key,default)!=first.get(key,default):
+                raise ValueError('all sweep configurations need the same '+key)
+        if inp_struct['Nruns']!=1 or inp_struct.get('taper') is not None:
+            raise ValueError('sweep configurations run with Nruns=1 and without taper')
+        for key in ['stop_after','stop_drop','checkpoint_dir','output_file']:
+            if inp_struct.get(key) is not None:
+                raise ValueError('sweeps do not support '+key)
+    if first['iopt'] not in ('sase','seeded'):
+        raise ValueError('unknown iopt '+str(first['iopt']))
+
+    #calculating intermediate parameters and loading buckets, in the order of separate runs
+    params=[]
+    buckets=[]
+    for inp_struct in inp_structs:
+        params.append(sase1d_input_part.params_calc(**inp_struct))
+        buckets.append(sase1d_input_part.load_buckets(inp_struct,params[-1]))
+    s_steps=buckets[0]['s_steps']
+    if any(bucket_data['s_steps']!=s_steps for bucket_data in buckets):
+        raise ValueError('the particle inputs give different numbers of slices')
+    npart=first['npart']
+    z_steps=first['z_steps']
+
+    #stack along the batch axis: (B,1,1) for particle coefficients, (B,1) for field ones
+    dtype=np.dtype(first.get('dtype','float64'))
+    wrap=dtype!=np.float64
+    batch=lambda name: np.array([p[name] for p in params])
+    thet_init=np.stack([b['thet_init'] for b in buckets]).astype(dtype)
+    eta_init=np.stack([b['eta_init'] for b in buckets]).astype(dtype)
+    shape=np.stack([b['N_real']/np.max(b['N_real']) for b in buckets]).astype(dtype)
+    E02=batch('E02')[:,np.newaxis]
+    ku=batch('ku').astype(dtype)[:,np.newaxis,np.newaxis]
+    delt=batch('delt').astype(dtype)[:,np.newaxis,np.newaxis]
+    dels=batch('dels').astype(dtype)[:,np.newaxis]
+    deta=batch('deta').astype(dtype).T[:,:,np.newaxis,np.newaxis]          # (z_steps, B, 1, 1)
+    kappa=np.array([p['kappa_1']*p['density'] for p in params]).astype(dtype).T[:,:,np.newaxis]
+    Kai=batch('Kai').astype(dtype).T[:,:,np.newaxis,np.newaxis]
+    record_z,record_slices=sase1d_input_part.record_policy(first.get('record_z'),first.get('record_slices'),s_steps,z_steps)
+    slip=None
+    if first['iopt']=='seeded':
+        slip={'every':first.get('slip_every',1),'mode':'none'}              # steady state buckets, field step delt
+    elif first.get('slip_every',1)!=1 or first.get('slippage','step')!='step':
+        slip={'every':first.get('slip_every',1),'mode':first.get('slippage','step')}
+
+    balance={} if first.get('energy_balance',False) else None
+    fine={} if first.get('step_error',False) else None
+
+    Er,Ei,bunching,thet_record,eta_record,etaavg=sase1d_input_part.FEL_process_zmajor(thet_init,eta_init,shape,E02,\
+        npart,z_steps,ku,delt,dels,deta,kappa,Kai,record_z,record_slices,wrap,slip=slip,\
+        integrator=first.get('integrator','leapfrog'),balance=balance,fine=fine)
+
+    #finalize every configuration on its own
+    outputs=[]
+    for b,inp_struct in enumerate(inp_structs):
+        p=params[b]
+        s=np.arange(1,s_steps+1)*p['dels']*p['coopLength']*1.0e6
+        z=np.arange(1,z_steps+1)*p['delt']*p['gainLength']
+        FEL_data={'Er':Er[b],'Ei':Ei[b],'s':s,'z':z,'bunching':bunching[b],'bunchLength':s[-1]*1e-6,\
+                  'thet_output':np.swapaxes(thet_record[b,-1],-1,-2) if record_slices.shape[0] else None,\
+                  'eta':np.swapaxes(eta_record[b,-1],-1,-2) if record_slices.shape[0] else None,\
+                  'thet_record':thet_record[b],'eta_record':eta_record[b],'recorded_z':record_z,\
+                  'recorded_slices':record_slices,'etaavg':etaavg[b],'taper_unduK':inp_struct['unduK'],\
+                  'field_gain':None if balance is None else balance['field_gain'][b],\
+                  'beam_loss':None if balance is None else balance['beam_loss'][b],\
+                  'fine_power':None if fine is None else fine['power'][b]}
+        final_params={}
+        final_params.update(FEL_data)
+        final_params.update(inp_struct)
+        final_params.update(p)
+        final_params.update(buckets[b])
+        final_data=sase1d_input_part.final_calc(**final_params)
+        outputs.append(sase1d_input_part.sase_outputs(p,FEL_data,final_data))
+    return outputs
+
+
+def detuning_scan(inp_struct,radWavelength):
+    '''
+    seeded gain curves against the seed wavelength: the steady-state buckets of all the
+    detunings (gbar) are advanced together in one run_sweep pass
+    inputs:
+    inp_struct          # sase() input dict with iopt='seeded' and Nruns=1
+    radWavelength       # seed wavelengths [m]
+    outputs:
+    z                   # positions along the undulator [m]
+    power_z             # power along the undulator for every seed wavelength, shape (len(radWavelength), z_steps)
+    gbar                # scaled detune parameter of every seed wavelength
+    the curves are the same as separate sase() runs with each radWavelength
+    '''
+    if inp_struct['iopt']!='seeded':
+        raise ValueError("detuning scans run in iopt='seeded' mode")
+    radWavelength=np.atleast_1d(np.asarray(radWavelength,dtype=float))
+    outputs=run_sweep([dict(inp_struct,radWavelength=wavelength) for wavelength in radWavelength])
+    resWavelength=outputs[0][9]
+    power_z=np.stack([output[1] for output in outputs])
+    return outputs[0][0],power_z,(resWavelength-radWavelength)/radWavelength
@@ -0,0 +1,156 @@
+import os
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+
+def FEL_process_wavefront(thet_init,eta_init,shape,E02,npart,z_steps,ku,delt,dels,deta,kappa,Kai,\
+                          record_z,record_slices,wrap=False,nworkers=None,z_chunk=None):
+    '''
+    wavefront pipeline over the bunch slices, same inputs and outputs as FEL_process_zmajor
+    every worker process owns a contiguous block of slices and runs the z-major leap-frog
+    on it chunk by chunk; the field row leaving its head slice is handed to the next worker
+    through shared memory once a z chunk is done
+    inputs:
+    nworkers            # number of worker processes, default all cores (at most s_steps)
+    z_chunk             # z steps per chunk handed downstream, default z_steps/(4*nworkers)
+    wrap                # wrap theta modulo 2 pi after every step
+    outputs:
+    Er, Ei              # field grid, shape (s_steps+1, z_steps+1)
+    bunching            # bunching factor, shape (s_steps, z_steps)
+    thet_record         # recorded phases, shape (len(record_slices), len(record_z), npart)
+    eta_record          # recorded relative energies, same shape as thet_record
+    etaavg              # average energy of the last slice after every step, shape (z_steps,)
+    '''
+    s_steps=thet_init.shape[0]
+    if nworkers is None:
+        nworkers=os.cpu_count()
+    nworkers=max(1,min(int(nworkers),s_steps))
+    if z_chunk is None:
+        z_chunk=max(1,z_steps//(4*nworkers))
+
+    real=thet_init.dtype
+    ctx=multiprocessing.get_context()
+    handles={}
+    arrays={}
+    try:
+        for name,shp,dtype in [('Er',(s_steps+1,z_steps+1),real),('Ei',(s_steps+1,z_steps+1),real),\
+                               ('bunching',(s_steps,z_steps),np.result_type(real,np.complex64)),('etaavg',(z_steps,),real),\
+                               ('thet_record',(record_slices.shape[0],record_z.shape[0],npart),real),\
+                               ('eta_record',(record_slices.shape[0],record_z.shape[0],npart),real),\
+                               ('thet_init',thet_init.shape,real),('eta_init',eta_init.shape,real)]:
+            handles[name],arrays[name]=shared_array(shp,dtype)
+        arrays['thet_init'][...]=thet_init
+        arrays['eta_init'][...]=eta_init
+        arrays['Er'][:s_steps,0]=np.sqrt(E02)                               # input seed signal
+        layout={name:(handles[name].name,arr.shape,arr.dtype.str) for name,arr in arrays.items()}
+
+        blocks=np.array_split(np.arange(s_steps),nworkers)
+        ready=[ctx.Semaphore(0) for w in range(nworkers+1)]
+        workers=[]
+        for w,block in enumerate(blocks):
+            args=(layout,int(block[0]),int(block[-1])+1,w>0,ready[w],ready[w+1],shape,npart,z_steps,\
+                  ku,delt,dels,deta,kappa,Kai,record_z,record_slices,wrap,z_chunk)
+            workers.append(ctx.Process(target=wavefront_worker,args=args,daemon=True))
+        for p in workers:
+            p.start()
+        wait_workers(workers)
+
+        outputs=[arrays[name].copy() for name in ['Er','Ei','bunching','thet_record','eta_record','etaavg']]
+    finally:
+        arrays.clear()                                                      # views must go before close
+        for shm in handles.values():
+            shm.close()
+            shm.unlink()
+    return tuple(outputs)
+
+
+def wavefront_worker(layout,k0,k1,upstream,ready_in,ready_out,shape,npart,z_steps,\
+                     ku,delt,dels,deta,kappa,Kai,record_z,record_slices,wrap,z_chunk):
+    '''
+    pipeline worker: attach to the shared buffers and advance slices k0..k1-1
+    '''
+    handles={}
+    arrays={}
+    try:
+        for name,spec in layout.items():
+            handles[name],arrays[name]=attach_array(*spec)
+        advance_block(arrays,k0,k1,upstream,ready_in,ready_out,shape,npart,z_steps,\
+                      ku,delt,dels,deta,kappa,Kai,record_z,record_slices,wrap,z_chunk)
+    finally:
+        arrays.clear()
+        for shm in handles.values():
+            shm.close()
+
+
+def advance_block(arrays,k0,k1,upstream,ready_in,ready_out,shape,npart,z_steps,\
+                  ku,delt,dels,deta,kappa,Kai,record_z,record_slices,wrap,z_chunk):
+    '''
+    advance slices k0..k1-1 along the undulator, one z chunk at a time
+    the chunk starts once the upstream worker has released it (ready_in) and
+    is released downstream (ready_out) once the field rows are written
+    '''
+    from zfel.sase1d_input_part import leapfrog_step,record_slots
+    Er=arrays['Er']
+    Ei=arrays['Ei']
+    bunching=arrays['bunching']
+    last=k1==arrays['thet_init'].shape[0]
+    z_slot=record_slots(record_z,z_steps+1)
+    mine=(record_slices>=k0)&(record_slices<k1)
+    rows=np.nonzero(mine)[0]                                                # record rows owned by this block
+    local=record_slices[mine]-k0
+    eta_s=arrays['eta_init'][k0:k1].copy()
+    thet0=arrays['thet_init'][k0:k1]
+    thethalf=thet0-2*ku*eta_s*delt/2                                        # half back
+    if z_slot[0]>=0:
+        arrays['thet_record'][rows,z_slot[0]]=thet0[local]
+        arrays['eta_record'][rows,z_slot[0]]=eta_s[local]
+    for j0 in range(0,z_steps,z_chunk):
+        if upstream:
+            ready_in.acquire()
+        for j in range(j0,min(j0+z_chunk,z_steps)):
+            thet,thethalf,eta_s,Er[k0+1:k1+1,j+1],Ei[k0+1:k1+1,j+1],bunching[k0:k1,j]=leapfrog_step(\
+                thethalf,eta_s,Er[k0:k1,j],Ei[k0:k1,j],shape[k0:k1],npart,ku,delt,dels,deta[j],kappa[j],Kai[j],wrap)
+            if z_slot[j+1]>=0:
+                arrays['thet_record'][rows,z_slot[j+1]]=thet[local]
+                arrays['eta_record'][rows,z_slot[j+1]]=eta_s[local]
+            if last:
+                arrays['etaavg'][j]=np.sum(eta_s[-1,:])/npart
+        ready_out.release()
+
+
+def wait_workers(workers):
+    '''
+    join the pipeline workers; a failed worker would stall everything downstream,
+    so stop the others and raise
+    '''
+    while any(p.is_alive() for p in workers):
+        for p in workers:
+            p.join(timeout=0.1)
+            if p.exitcode not in (None,0):
+                for q in workers:
+                    q.terminate()
+                raise RuntimeError('wavefront worker exited with code '+str(p.exitcode))
+    for p in workers:
+        if p.exitcode!=0:
+            raise RuntimeError('wavefront worker exited with code '+str(p.exitcode))
+
+
+def shared_array(shape,dtype):
+    '''
+    new zero-filled array in shared memory, returns (SharedMemory, ndarray)
+    '''
+    dtype=np.dtype(dtype)
+    nbytes=max(1,int(np.prod(shape))*dtype.itemsize)
+    shm=shared_memory.SharedMemory(create=True,size=nbytes)
+    arr=np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+    arr[...]=0
+    return shm,arr
+
+
+def attach_array(name,shape,dtype):
+    '''
+    attach to an array created by shared_array, returns (SharedMemory, ndarray)
+    '''
+    shm=shared_memory.SharedMemory(name=name)
+    return shm,np.ndarray(shape,dtype=np.dtype(dtype),buffer=shm.buf)